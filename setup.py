@@ -30,6 +30,16 @@ install_requires = []
 if sys.version_info < (2, 7):
     install_requires += ['argparse']
 
+py_modules = ["stackcollapse_common", "stackcollapse_hprof", "stackcollapse_hpl", "stackcollapse_jfr"]
+console_scripts = [
+    'stackcollapse-hprof = stackcollapse_hprof:main',
+    'stackcollapse-hpl = stackcollapse_hpl:main',
+    'stackcollapse-jfr = stackcollapse_jfr:main',
+]
+if sys.version_info >= (3, 5):
+    py_modules += ["stackcollapse_server"]
+    console_scripts += ['stackcollapse-server = stackcollapse_server:main']
+
 
 setup(
     name="hprof2flamegraph",
@@ -51,12 +61,9 @@ setup(
         "Topic :: Software Development",
     ],
     install_requires=install_requires,
-    py_modules=["stackcollapse_hprof", "stackcollapse_hpl"],
+    py_modules=py_modules,
     entry_points={
-        'console_scripts': [
-            'stackcollapse-hprof = stackcollapse_hprof:main',
-            'stackcollapse-hpl = stackcollapse_hpl:main',
-        ]
+        'console_scripts': console_scripts
     },
     scripts=['flamegraph.pl'],
     test_suite='nose.collector'
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2014, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Helpers shared by the stackcollapse scripts.
+"""
+
+import argparse
+import heapq
+import json
+import re
+import sys
+import tempfile
+
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+
+
+class StackFilter(object):
+    """ Drop, truncate and fold the frames of a stack.
+
+    Stacks are lists of frames ordered from the leaf to the root, as built by the
+    parsers. key_of reduces a frame to a method key and name_of turns a key into the
+    method name the regular expressions are matched against. Names and regular
+    expressions are only evaluated once per distinct key. Recursion is detected by
+    comparing method names, so distinct keys sharing a name are folded together.
+    """
+
+    def __init__(self, key_of, name_of, include=None, exclude=None, root=None,
+                 max_depth=None, collapse_recursion=False):
+        self.key_of = key_of
+        self.name_of = name_of
+        self.include = [re.compile(pattern) for pattern in include or []]
+        self.exclude = [re.compile(pattern) for pattern in exclude or []]
+        self.root = re.compile(root) if root else None
+        self.max_depth = max_depth
+        self.collapse_recursion = collapse_recursion
+        self._decisions = {}
+
+    def _decide(self, key):
+        """ Return a (name, kept, is_root) tuple for a method key"""
+        decision = self._decisions.get(key)
+        if decision is None:
+            name = self.name_of(key)
+            kept = not self.include or any(p.search(name) for p in self.include)
+            kept = kept and not any(p.search(name) for p in self.exclude)
+            is_root = self.root is not None and self.root.search(name) is not None
+            decision = self._decisions[key] = (name, kept, is_root)
+        return decision
+
+    def __call__(self, stack):
+        """ Return the filtered stack, empty if the whole stack must be discarded"""
+        frames = []
+        previous_name = None
+        found_root = self.root is None
+        for frame in reversed(stack):
+            (name, kept, is_root) = self._decide(self.key_of(frame))
+            if not found_root:
+                if not is_root:
+                    continue
+                found_root = True
+            if not kept:
+                continue
+            if self.collapse_recursion and name == previous_name:
+                continue
+            previous_name = name
+            frames.append(frame)
+            if self.max_depth and len(frames) >= self.max_depth:
+                break
+
+        frames.reverse()
+        return frames
+
+
+def positive_int(value):
+    """ argparse type of the options only accepting integers greater than 0"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('%s is not a positive integer' % value)
+    return number
+
+
+def abbreviate_package(name):
+    """ Abbreviate the package of a qualified method name: foo.bar.Class.method -> f.b.Class.method
+
+    If a package name cannot be found the string is unchanged
+    """
+    match_object = re.match(r'(?P<package>.*\.)(?P<remainder>[^.]+\.[^.]+)$', name)
+    if match_object is None:
+        return name
+
+    shortened_pkg = re.sub(r'(\w)\w*', r'\1', match_object.group('package'))
+    return "%s%s" % (shortened_pkg, match_object.group('remainder'))
+
+
+def add_filter_arguments(parser):
+    """ Register the frame filtering options on an argparse parser"""
+    parser.add_argument('--include', dest='include', metavar='REGEX', action='append',
+                        help='Only keep frames matching REGEX (can be repeated)')
+    parser.add_argument('--exclude', dest='exclude', metavar='REGEX', action='append',
+                        help='Remove frames matching REGEX (can be repeated)')
+    parser.add_argument('--root', dest='root', metavar='REGEX',
+                        help='Truncate stacks at the outermost frame matching REGEX, discard stacks without one')
+    parser.add_argument('--max-depth', dest='max_depth', metavar='N', type=positive_int,
+                        help='Only keep the N outermost frames of each stack')
+    parser.add_argument('--collapse-recursion', dest='collapse_recursion', action='store_true',
+                        help='Fold consecutive frames of the same method into one')
+
+
+def get_stack_filter(args, key_of, name_of):
+    """ Build a StackFilter from the parsed options. Return None if no filtering is requested."""
+    if not (args.include or args.exclude or args.root or args.max_depth or args.collapse_recursion):
+        return None
+
+    return StackFilter(
+        key_of, name_of,
+        include=args.include,
+        exclude=args.exclude,
+        root=args.root,
+        max_depth=args.max_depth,
+        collapse_recursion=args.collapse_recursion,
+    )
+
+
+def add_pruning_arguments(parser):
+    """ Register the stack pruning options on an argparse parser"""
+    parser.add_argument('--min-count', dest='min_count', metavar='N', type=int, default=0,
+                        help='Merge stacks with less than N samples into their deepest ancestor '
+                             'whose subtree has at least N samples')
+    parser.add_argument('--min-percent', dest='min_percent', metavar='P', type=float, default=0.0,
+                        help='Merge stacks with less than P percent of the samples into their deepest ancestor '
+                             'whose subtree has at least P percent of the samples')
+    parser.add_argument('--max-stacks', dest='max_stacks', metavar='N', type=positive_int,
+                        help='Only output the N heaviest stacks')
+
+
+def prune_stacks(folded_stacks, min_count=0, min_percent=0.0, max_stacks=None):
+    """ Remove the negligible stacks from a dict of sample counts indexed by folded stack.
+
+    A stack with less samples than the threshold is truncated to its deepest ancestor
+    whose subtree has enough samples, and its samples are added to it. The ancestor's own
+    count may still be below the threshold. Stacks without such an ancestor are dropped.
+    Then only the max_stacks heaviest stacks are kept. Return a new dict.
+    """
+    total = sum(folded_stacks.values())
+    threshold = max(min_count, total * min_percent / 100.0)
+
+    if any(count < threshold for count in folded_stacks.values()):
+        # Sample count of the subtree rooted at each frame: node = [count, children]
+        tree = [0, {}]
+        for (folded_stack, count) in folded_stacks.items():
+            node = tree
+            for frame in folded_stack.split(';'):
+                node = node[1].setdefault(frame, [0, {}])
+                node[0] += count
+
+        pruned_stacks = {}
+        for (folded_stack, count) in folded_stacks.items():
+            if count >= threshold:
+                pruned_stacks[folded_stack] = pruned_stacks.get(folded_stack, 0) + count
+                continue
+
+            frames = folded_stack.split(';')
+            node = tree
+            depth = 0
+            for frame in frames:
+                node = node[1][frame]
+                if node[0] < threshold:
+                    break
+                depth += 1
+
+            if depth:
+                ancestor = ';'.join(frames[:depth])
+                pruned_stacks[ancestor] = pruned_stacks.get(ancestor, 0) + count
+        folded_stacks = pruned_stacks
+
+    if max_stacks is not None and len(folded_stacks) > max_stacks:
+        folded_stacks = dict(heapq.nlargest(max_stacks, folded_stacks.items(), key=lambda item: item[1]))
+
+    return folded_stacks
+
+
+class SpillingCounter(object):
+    """ Count samples by folded stack within a memory budget.
+
+    It is used like a collections.defaultdict(int). Once the estimated size of the
+    counts exceeds max_memory bytes, they are sorted and spilled into a temporary file.
+    Once there are MAX_RUNS spilled runs, they are merged into one, so that the number
+    of open files stays bounded. items() merges the spilled runs with the remaining
+    counts and yields the (folded stack, count) pairs sorted by folded stack, like
+    sorted() would.
+    """
+
+    # Approximate size of a dict entry and its int value, on top of the key
+    ENTRY_OVERHEAD = 100
+    # Maximum number of runs, each one keeping a temporary file open
+    MAX_RUNS = 64
+
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.counts = {}
+        self.size = 0
+        self.runs = []
+
+    def __getitem__(self, folded_stack):
+        return self.counts.get(folded_stack, 0)
+
+    def __setitem__(self, folded_stack, count):
+        if folded_stack not in self.counts:
+            self.size += sys.getsizeof(folded_stack) + self.ENTRY_OVERHEAD
+        self.counts[folded_stack] = count
+        if self.size > self.max_memory:
+            self.spill()
+
+    def spill(self):
+        """ Write the counts to a temporary file, sorted by folded stack, and clear them"""
+        sorted_items = ((folded_stack, self.counts[folded_stack]) for folded_stack in sorted(self.counts))
+        self.runs.append(self._write_run(sorted_items))
+        self.counts = {}
+        self.size = 0
+        if len(self.runs) >= self.MAX_RUNS:
+            runs = [self._read_run(run) for run in self.runs]
+            self.runs = [self._write_run(self._merge(runs))]
+
+    @staticmethod
+    def _write_run(sorted_items):
+        run = tempfile.TemporaryFile()
+        for (folded_stack, count) in sorted_items:
+            run.write(('%s %s\n' % (folded_stack, count)).encode('utf-8'))
+        run.seek(0)
+        return run
+
+    @staticmethod
+    def _read_run(run):
+        try:
+            for line in run:
+                (folded_stack, count) = line.decode('utf-8').rstrip('\n').rsplit(' ', 1)
+                yield folded_stack, int(count)
+        finally:
+            run.close()
+
+    def items(self):
+        """ Return an iterator of the (folded stack, count) pairs sorted by folded stack. Can only be called once."""
+        # UTF-8 preserves the code point order, the runs are sorted like the strings
+        in_memory = [(folded_stack, self.counts[folded_stack]) for folded_stack in sorted(self.counts)]
+        self.counts = {}
+        runs = [self._read_run(run) for run in self.runs] + [iter(in_memory)]
+        self.runs = []
+        return self._merge(runs)
+
+    @staticmethod
+    def _merge(runs):
+        """ Merge sorted (folded stack, count) iterables, adding the counts of the same stack"""
+        previous_stack = None
+        total = 0
+        for (folded_stack, count) in heapq.merge(*runs):
+            if folded_stack == previous_stack:
+                total += count
+                continue
+            if previous_stack is not None:
+                yield previous_stack, total
+            previous_stack = folded_stack
+            total = count
+        if previous_stack is not None:
+            yield previous_stack, total
+
+
+def add_format_argument(parser):
+    """ Register the output format option on an argparse parser"""
+    parser.add_argument('--format', dest='format', choices=('folded', 'speedscope'), default='folded',
+                        help='Output folded stacks for flamegraph.pl (default) or a speedscope JSON file')
+
+
+def write_speedscope(folded_stacks, out, name='', unit='none'):
+    """ Write (folded stack, count) pairs as a speedscope JSON document.
+
+    Each thread gets its own sampled profile, named after the "Thread ..." root frame of
+    its stacks. Stacks without thread go to a profile called name. The document is
+    written as the stacks are read, so the stacks of a thread must be consecutive, like
+    sorted() orders them, or a ValueError is raised. A stack made of the thread frame
+    alone is the exception: it sorts apart from the other stacks of its thread
+    ("Thread 1" < "Thread 10;..." < "Thread 1;..."), so it is held back and written as
+    an empty sample of its thread profile. Frames are interned in the shared frame table,
+    which is written last, and samples refer to them by index.
+    """
+    frame_ids = {}
+    frames = []
+    # Counts of the stacks made of a thread frame alone, indexed by thread
+    thread_counts = {}
+    written_profiles = set()
+    profile_name = None
+    weights = []
+
+    out.write('{"$schema": %s, "exporter": "hprof2flamegraph", "name": %s, "activeProfileIndex": 0, "profiles": [' % (
+        json.dumps(SPEEDSCOPE_SCHEMA), json.dumps(name)))
+
+    def write_sample(stack_profile_name, stack, count):
+        if stack_profile_name != profile_name or not weights:
+            if stack_profile_name in written_profiles:
+                raise ValueError('The stacks of %s are not consecutive' % stack_profile_name)
+            if weights:
+                _end_speedscope_profile(out, weights)
+                out.write(', ')
+            out.write('{"type": "sampled", "name": %s, "unit": %s, "startValue": 0, "samples": [' % (
+                json.dumps(stack_profile_name), json.dumps(unit)))
+            written_profiles.add(stack_profile_name)
+            del weights[:]
+            if stack and stack_profile_name in thread_counts:
+                out.write('[], ')
+                weights.append(thread_counts.pop(stack_profile_name))
+        else:
+            out.write(', ')
+
+        sample = []
+        for frame in stack:
+            frame_id = frame_ids.get(frame)
+            if frame_id is None:
+                frame_id = frame_ids[frame] = len(frames)
+                frames.append(frame)
+            sample.append(str(frame_id))
+        out.write('[%s]' % ', '.join(sample))
+        weights.append(count)
+        return stack_profile_name
+
+    for (folded_stack, count) in folded_stacks:
+        stack = folded_stack.split(';')
+        stack_profile_name = name
+        if stack[0].startswith('Thread '):
+            stack_profile_name = stack.pop(0)
+            if not stack and stack_profile_name != profile_name:
+                thread_counts[stack_profile_name] = thread_counts.get(stack_profile_name, 0) + count
+                continue
+        profile_name = write_sample(stack_profile_name, stack, count)
+
+    # Threads without any other stack
+    for thread in sorted(thread_counts):
+        profile_name = write_sample(thread, [], thread_counts[thread])
+
+    if weights:
+        _end_speedscope_profile(out, weights)
+
+    out.write('], "shared": {"frames": [')
+    for (frame_id, frame) in enumerate(frames):
+        out.write('%s{"name": %s}' % (', ' if frame_id else '', json.dumps(frame)))
+    out.write(']}}\n')
+
+
+def _end_speedscope_profile(out, weights):
+    out.write('], "weights": [%s], "endValue": %s}' % (', '.join(str(weight) for weight in weights), sum(weights)))
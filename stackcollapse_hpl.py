@@ -28,11 +28,15 @@ from __future__ import print_function
 
 import struct
 import collections
+import os
 import sys
-import re
 
-Method = collections.namedtuple('Method', ['id', 'file_name', 'class_name', 'method_name'])
-Trace = collections.namedtuple('Trace', ['thread_id', 'frame_count', 'frames'])
+from stackcollapse_common import (abbreviate_package, add_filter_arguments, add_format_argument, add_pruning_arguments,
+                                  get_stack_filter, positive_int, prune_stacks, write_speedscope, SpillingCounter)
+
+# Methods are indexed by id in the method table, only the fields used by the options are kept
+Method = collections.namedtuple('Method', ['class_name', 'method_name'])
+Trace = collections.namedtuple('Trace', ['thread_id', 'frame_count', 'frames', 'time'])
 Frame = collections.namedtuple('Frame', ['bci', 'line_no', 'method_id'])
 
 AGENT_ERRORS = [
@@ -50,20 +54,44 @@ AGENT_ERRORS = [
 ]
 
 
-def parse_hpl_string(fh):
+def parse_hpl_string(fh, strings=None):
+    """ Read a length-prefixed UTF-8 string.
+
+    If strings is set, it maps the raw bytes already read to their decoded string, so
+    each distinct string is decoded once and shared by all the methods using it.
+    """
     (length,) = struct.unpack('>i', fh.read(4))
     (val,) = struct.unpack('>%ss' % length, fh.read(length))
-    return val.decode('utf-8')
+    if strings is None:
+        return val.decode('utf-8')
 
+    string = strings.get(val)
+    if string is None:
+        string = strings[val] = val.decode('utf-8')
+    return string
+
+
+def skip_hpl_string(fh):
+    """ Skip a length-prefixed string without reading it"""
+    (length,) = struct.unpack('>i', fh.read(4))
+    fh.seek(length, 1)
 
-def parse_hpl(filename):
-    traces = []
-    methods = {}
+
+def iter_hpl(filename, methods):
+    """ Yield the traces of a hpl file as they are read.
+
+    methods is filled with the method table while the file is read. A trace is only
+    yielded once the next one starts, its methods being then known, so that it can be
+    processed and dropped without keeping every sample in memory.
+    """
+    # Class and method names are shared by many methods
+    strings = {}
 
     for (index, error) in enumerate(AGENT_ERRORS):
         method_id = -1 - index
-        methods[method_id] = Method(method_id, "", "/Error/", error)
+        methods[method_id] = Method("/Error/", error)
 
+    trace = None
     with open(filename, 'rb') as fh:
         while True:
             marker_str = fh.read(1)
@@ -74,59 +102,62 @@ def parse_hpl(filename):
             if marker == 0:
                 break
             elif marker == 1 or marker == 11:
+                if trace is not None:
+                    yield trace
                 (frame_count, thread_id) = struct.unpack('>iQ', fh.read(4 + 8))
+                time = None
                 # marker is 11, read the time
                 if marker == 11:
                     (time_sec, time_nano) = struct.unpack('>QQ', fh.read(8+8))
+                    time = time_sec + time_nano / 1e9
                 if frame_count > 0:
-                    traces.append(Trace(thread_id, frame_count, []))
+                    trace = Trace(thread_id, frame_count, [], time)
                 else:  # Negative frame_count are used to report error
                     if abs(frame_count) > len(AGENT_ERRORS):
                         method_id = frame_count - 1
-                        methods[method_id] = Method(method_id, "Unknown err[ERR=%s]" % frame_count)
+                        methods[method_id] = Method("/Error/", "Unknown err[ERR=%s]" % frame_count)
                     frame = Frame(None, None, frame_count - 1)
-                    traces.append(Trace(thread_id, 1, [frame]))
+                    trace = Trace(thread_id, 1, [frame], time)
             elif marker == 2:
                 (bci, method_id) = struct.unpack('>iQ', fh.read(4 + 8))
                 frame = Frame(bci, None, method_id)
-                traces[-1].frames.append(frame)
+                trace.frames.append(frame)
             elif marker == 21:
                 (bci, line_no, method_id) = struct.unpack('>iiQ', fh.read(4 + 4 + 8))
                 if line_no < 0:  # Negative line_no are used to report that line_no is not available (-100 & -101)
                     line_no = None
                 frame = Frame(bci, line_no, method_id)
-                traces[-1].frames.append(frame)
+                trace.frames.append(frame)
             elif marker == 3:
                 (method_id,) = struct.unpack('>Q', fh.read(8))
-                file_name = parse_hpl_string(fh)
-                class_name = parse_hpl_string(fh)
-                method_name = parse_hpl_string(fh)
-                methods[method_id] = Method(method_id, file_name, class_name, method_name)
+                skip_hpl_string(fh)  # file_name
+                class_name = parse_hpl_string(fh, strings)
+                method_name = parse_hpl_string(fh, strings)
+                methods[method_id] = Method(class_name, method_name)
             elif marker == 31:
                 (method_id,) = struct.unpack('>Q', fh.read(8))
-                file_name = parse_hpl_string(fh)
-                class_name = parse_hpl_string(fh)
-                class_name_generic = parse_hpl_string(fh)
-                method_name = parse_hpl_string(fh)
-                method_signature = parse_hpl_string(fh)
-                method_signature_generic = parse_hpl_string(fh)
-                methods[method_id] = Method(method_id, file_name, class_name, method_name)
+                skip_hpl_string(fh)  # file_name
+                class_name = parse_hpl_string(fh, strings)
+                skip_hpl_string(fh)  # class_name_generic
+                method_name = parse_hpl_string(fh, strings)
+                skip_hpl_string(fh)  # method_signature
+                skip_hpl_string(fh)  # method_signature_generic
+                methods[method_id] = Method(class_name, method_name)
             elif marker == 4: # 4 means thread meta, not useful in flame graph
-                (thread_id,) = struct.unpack('>Q', fh.read(8))
-                thread_name = parse_hpl_string(fh)
+                fh.seek(8, 1)  # thread_id
+                skip_hpl_string(fh)  # thread_name
             else:
                 raise Exception("Unexpected marker: %s at offset %s" % (marker, fh.tell()))
 
-    return traces, methods
-
+    if trace is not None:
+        yield trace
 
-def abbreviate_package(class_name):
-    match_object = re.match(r'(?P<package>.*\.)(?P<remainder>[^.]+\.[^.]+)$', class_name)
-    if match_object is None:
-        return class_name
 
-    shortened_pkg = re.sub(r'(\w)\w*', r'\1', match_object.group('package'))
-    return "%s%s" % (shortened_pkg, match_object.group('remainder'))
+def parse_hpl(filename):
+    """ Read a hpl file. Return the list of traces and the method table indexed by method id."""
+    methods = {}
+    traces = list(iter_hpl(filename, methods))
+    return traces, methods
 
 
 def get_method_name(method, shorten_pkgs):
@@ -146,6 +177,28 @@ def format_frame(frame, method, discard_lineno, shorten_pkgs):
     return formatted_frame
 
 
+def iter_trace_frames(traces, methods, discard_lineno=False, shorten_pkgs=False,
+                      skip_trace_on_missing_frame=False, stack_filter=None):
+    """ Yield a (trace, frames) tuple for each trace, frames being formatted and ordered from the leaf to the root"""
+    for trace in traces:
+        trace_frames = trace.frames
+        if skip_trace_on_missing_frame:
+            missing = [frame.method_id for frame in trace_frames if frame.method_id not in methods]
+            if missing:
+                sys.stderr.write("skipped missing frame %s\n" % missing[0])
+                continue
+
+        if stack_filter:
+            trace_frames = stack_filter(trace_frames)
+            if not trace_frames:
+                continue
+
+        yield trace, [
+            format_frame(frame, methods[frame.method_id], discard_lineno, shorten_pkgs)
+            for frame in trace_frames
+        ]
+
+
 def main(argv=None, out=sys.stdout):
     import argparse
 
@@ -155,40 +208,55 @@ def main(argv=None, out=sys.stdout):
     parser.add_argument('--discard-thread', dest='discard_thread', action='store_true', help='Remove thread info')
     parser.add_argument('--shorten-pkgs', dest='shorten_pkgs', action='store_true', help='Shorten package names')
     parser.add_argument('--skip-trace-on-missing-frame', dest='skip_trace_on_missing_frame', action='store_true', help='Continue processing even if frames are missing')
+    parser.add_argument('--max-memory', dest='max_memory', metavar='MB', type=positive_int,
+                        help='Spill the distinct stacks to temporary files once they use about MB megabytes')
+    add_filter_arguments(parser)
+    add_pruning_arguments(parser)
+    add_format_argument(parser)
 
     args = parser.parse_args(argv)
     filename = args.hpl_file[0]
-
-    (traces, methods) = parse_hpl(filename)
-
-    folded_stacks = collections.defaultdict(int)
-
-    for trace in traces:
-        frames = []
-        skip_trace = False
-        for frame in trace.frames:
-            if args.skip_trace_on_missing_frame and not frame.method_id in methods:
-                sys.stderr.write("skipped missing frame %s\n" % frame.method_id)
-                skip_trace = True
-                break
-            frames.append(format_frame(
-                frame,
-                methods[frame.method_id],
-                args.discard_lineno,
-                args.shorten_pkgs
-            ))
-
-        if skip_trace:
-            continue
-
+    if args.max_memory and (args.min_count or args.min_percent or args.max_stacks is not None):
+        parser.error('--min-count, --min-percent and --max-stacks cannot be used with --max-memory')
+
+    if args.max_memory:
+        # Fold each trace as it is read instead of loading all of them first
+        methods = {}
+        traces = iter_hpl(filename, methods)
+    else:
+        (traces, methods) = parse_hpl(filename)
+
+    stack_filter = get_stack_filter(
+        args,
+        lambda frame: frame.method_id,
+        lambda method_id: get_method_name(methods[method_id], args.shorten_pkgs)
+    )
+
+    if args.max_memory:
+        folded_stacks = SpillingCounter(args.max_memory * 1024 * 1024)
+    else:
+        folded_stacks = collections.defaultdict(int)
+
+    trace_frames = iter_trace_frames(traces, methods, args.discard_lineno, args.shorten_pkgs,
+                                     args.skip_trace_on_missing_frame, stack_filter)
+    for (trace, frames) in trace_frames:
         if not args.discard_thread:
             frames.append('Thread %s' % trace.thread_id)
 
         folded_stack = ';'.join(reversed(frames))
         folded_stacks[folded_stack] += 1
 
-    for folded_stack in sorted(folded_stacks):
-        sample_count = folded_stacks[folded_stack]
+    if args.max_memory:
+        sorted_stacks = folded_stacks.items()
+    else:
+        folded_stacks = prune_stacks(folded_stacks, args.min_count, args.min_percent, args.max_stacks)
+        sorted_stacks = ((folded_stack, folded_stacks[folded_stack]) for folded_stack in sorted(folded_stacks))
+
+    if args.format == 'speedscope':
+        write_speedscope(sorted_stacks, out, name=os.path.basename(filename))
+        return 0
+
+    for (folded_stack, sample_count) in sorted_stacks:
         print("%s %s" % (folded_stack, sample_count), file=out)
 
     return 0
@@ -49,10 +49,25 @@ Usage example:
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import mmap
+import os
 import re
 import sys
 from io import open
 
+from stackcollapse_common import (abbreviate_package, add_filter_arguments, add_format_argument, add_pruning_arguments,
+                                  get_stack_filter, prune_stacks, write_speedscope)
+
+Site = collections.namedtuple('Site', ['trace_id', 'class_name', 'live_bytes', 'live_objs', 'alloc_bytes', 'alloc_objs'])
+SITE_WEIGHTS = ('alloc_bytes', 'alloc_objs', 'live_bytes', 'live_objs')
+
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
+
 
 def get_file_content(filename):
     """ Return the content of filename as a single string"""
@@ -60,10 +75,34 @@ def get_file_content(filename):
         return f.read()
 
 
+def map_file(filename):
+    """ Return the content of filename as a read-only memory map.
+
+    The parsing functions accept it in place of a string. Only the parts they extract
+    are copied and decoded.
+    """
+    with open(filename, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files cannot be mapped
+            return b''
+
+
+def _compile(pattern, content, flags=0):
+    """ Compile pattern to match content, either a string or a bytes-like object"""
+    if not isinstance(content, text_type):
+        pattern = pattern.encode('ascii')
+    return re.compile(pattern, flags)
+
+
+def _to_text(value):
+    return value if isinstance(value, text_type) else value.decode('utf-8')
+
+
 def header_match(line):
     """ Return True if line match the HPROF header line, False otherwise"""
-    pattern = 'JAVA PROFILE \d.\d.\d, created \w+ \w+ +\d+ \d{2}:\d{2}:\d{2} \d{4}'
-    return re.match(pattern, line) is not None
+    pattern = r'JAVA PROFILE \d.\d.\d, created \w+ \w+ +\d+ \d{2}:\d{2}:\d{2} \d{4}'
+    return _compile(pattern, line).match(line) is not None
 
 
 def remove_unknown_lineno(stack_element, discard_lineno=False):
@@ -85,43 +124,59 @@ def remove_unknown_lineno(stack_element, discard_lineno=False):
             match_object.group('line'))
 
 
-def abbreviate_package(stack_line):
-    """ Abbreviate the package from a stack line: foo.bar.Class.method -> f.b.Class.method
+def _process_stack(stack, discard_lineno=False, shorten_pkgs=False, frames=None):
+    """ Process an HPROF stack to only get meaningful content.
 
-    In a package name cannot be found the string is unchanged
+    stack is either a string or bytes. frames caches the processed frame of each raw
+    line, so that each distinct line is only decoded and processed once.
     """
-    match_object = re.match(r'(?P<package>.*\.)(?P<remainder>[^.]+\.[^.]+)$', stack_line)
-    if match_object is None:
-        return stack_line
+    if frames is None:
+        frames = {}
 
-    shortened_pkg = re.sub(r'(\w)\w*', r'\1', match_object.group('package'))
-    return "%s%s" % (shortened_pkg, match_object.group('remainder'))
+    processed_stack = []
+    for line in stack.split('\n' if isinstance(stack, text_type) else b'\n'):
+        if not line:
+            continue
+        frame = frames.get(line)
+        if frame is None:
+            frame = remove_unknown_lineno(_to_text(line).strip(), discard_lineno)
+            if shorten_pkgs:
+                frame = abbreviate_package(frame)
+            frames[line] = frame
+        processed_stack.append(frame)
+    return processed_stack
 
 
-def _process_stack(stack, discard_lineno=False, shorten_pkgs=False):
-    """ Process an HPROF stack to only get meaningful content"""
-    stack = stack.split('\n')
-    stack = [line.strip() for line in stack if line]
-    stack = [remove_unknown_lineno(line, discard_lineno) for line in stack]
-    if shorten_pkgs:
-        stack = [abbreviate_package(line) for line in stack]
-    return stack
+def get_frame_method(frame):
+    """ Return the method part of a processed stack frame, without its line number"""
+    return frame.split(':', 1)[0]
 
 
-def get_stacks(content, discard_lineno=False, discard_thread=False, shorten_pkgs=False):
-    """ Get the stack traces from an hprof file. Return a dict indexed by trace ID. """
+def get_stacks(content, discard_lineno=False, discard_thread=False, shorten_pkgs=False, stack_filter=None):
+    """ Get the stack traces from an hprof file. Return a dict indexed by trace ID.
+
+    content is either a string or a bytes-like object like the map returned by map_file.
+    If stack_filter is set, it is applied to each stack before the thread information
+    is added. Traces whose stack ends up empty are discarded.
+    """
     stacks = {}
+    frames = {}
+    empty = '<empty>' if isinstance(content, text_type) else b'<empty>'
 
     pattern = r'TRACE (?P<trace_id>[0-9]+):( \(thread=(?P<thread_id>[0-9]+)\))?\n(?P<stack>(\t.+\n)+)'
-    match_objects = re.finditer(pattern, content, re.M)
+    match_objects = _compile(pattern, content, re.M).finditer(content)
     for match_object in match_objects:
-        trace_id  = match_object.group('trace_id')
-        if "<empty>" in match_object.group('stack'):
+        trace_id  = _to_text(match_object.group('trace_id'))
+        if empty in match_object.group('stack'):
             continue
-        stack     = _process_stack(match_object.group('stack'), discard_lineno, shorten_pkgs)
+        stack     = _process_stack(match_object.group('stack'), discard_lineno, shorten_pkgs, frames)
+        if stack_filter:
+            stack = stack_filter(stack)
+            if not stack:
+                continue
         thread_id = match_object.group('thread_id')
         if thread_id and not discard_thread:
-            stack.append("Thread {0}".format(thread_id))
+            stack.append("Thread {0}".format(_to_text(thread_id)))
 
         stacks[trace_id] = stack
 
@@ -138,11 +193,11 @@ def get_counts(content):
         return trace, count
 
     pattern = r'CPU SAMPLES BEGIN \(total = \d+\).+\nrank[^\n]+\n(?P<samples>([^\n]+\n)+)CPU SAMPLES END'
-    match_object = re.search(pattern, content, re.M)
+    match_object = _compile(pattern, content, re.M).search(content)
     if not match_object:
         return {}
 
-    samples = filter(None, match_object.group('samples').split('\n'))
+    samples = filter(None, _to_text(match_object.group('samples')).split('\n'))
 
     counts = {}
     for trace, count in [extract_trace_and_count(t) for t in samples]:
@@ -151,19 +206,110 @@ def get_counts(content):
     return counts
 
 
+def get_sites(content):
+    """ Get the allocation sites from an hprof file. Return a list of Site.
+
+    If the file contains several SITES records, only the last one is used since they
+    are cumulative.
+    """
+    pattern = r'SITES BEGIN \(.+\n.+\n *rank[^\n]+\n(?P<sites>([^\n]+\n)*?)SITES END'
+    match_object = None
+    for match_object in _compile(pattern, content, re.M).finditer(content):
+        pass
+    if not match_object:
+        return []
+
+    sites = []
+    for line in filter(None, _to_text(match_object.group('sites')).split('\n')):
+        fields = line.split()
+        sites.append(Site(fields[7], fields[8], int(fields[3]), int(fields[4]), int(fields[5]), int(fields[6])))
+
+    return sites
+
+
+def abbreviate_class_name(class_name):
+    """ Abbreviate the whole package of a class name: java.util.HashMap -> j.u.HashMap
+
+    Unlike abbreviate_package, which expects a method, the last component is the class.
+    """
+    (package, dot, name) = class_name.rpartition('.')
+    if not dot:
+        return class_name
+    return '{0}.{1}'.format(re.sub(r'(\w)\w*', r'\1', package), name)
+
+
+def get_allocation_stacks(stacks, sites, weight='alloc_bytes', shorten_pkgs=False, stack_filter=None):
+    """ Join the stack dumps and allocation sites.
+
+    The allocated class is added as the leaf frame of each stack, its package being
+    abbreviated like the one of the methods if shorten_pkgs is set. stacks must not be filtered yet: stack_filter is
+    applied once the class frame is added, so that it is filtered like the other frames.
+    Return a dict of weights indexed by folded stack, weight being one of SITE_WEIGHTS.
+    Sites without stack, or whose stack is discarded by the filter, are skipped.
+    """
+    folded_stacks = {}
+    for site in sites:
+        stack = stacks.get(site.trace_id)
+        if stack is None:
+            continue
+        thread = stack[-1] if stack and stack[-1].startswith('Thread ') else None
+        class_name = abbreviate_class_name(site.class_name) if shorten_pkgs else site.class_name
+        stack = [class_name] + (stack[:-1] if thread else stack)
+        if stack_filter:
+            stack = stack_filter(stack)
+            if not stack:
+                continue
+        if thread:
+            stack.append(thread)
+
+        stack = ";".join(reversed(stack))
+        folded_stacks[stack] = folded_stacks.get(stack, 0) + getattr(site, weight)
+
+    return folded_stacks
+
+
+def has_traces(content):
+    """ Return True if content contains at least one non empty stack trace"""
+    pattern = r'^TRACE [0-9]+:.*\n\t(?!<empty>)'
+    return _compile(pattern, content, re.M).search(content) is not None
+
+
 def is_tracing(content):
     """ Return True is the the cpu mode was tracing and not sampling"""
     pattern = r'CPU TIME \(ms\) BEGIN'
-    return re.search(pattern, content, re.M) is not None
+    return _compile(pattern, content, re.M).search(content) is not None
 
 
-def to_flamegraph(stacks, counts):
+def get_folded_stacks(stacks, counts):
+    """ Join the stack dumps and sample counts.
+
+    Return a dict of sample counts indexed by folded stack. Traces without stack are skipped.
+    """
+    folded_stacks = {}
+    for id in counts:
+        if id not in stacks:
+            continue
+        stack = ";".join(reversed(stacks[id]))
+        folded_stacks[stack] = folded_stacks.get(stack, 0) + int(counts[id])
+
+    return folded_stacks
+
+
+def to_flamegraph(stacks, counts, min_count=0, min_percent=0.0, max_stacks=None, merge=False):
     """ Convert the stack dumps and sample counts into the flamegraph format.
 
-    Return a list of lines.
+    If merge is set or pruning is requested, identical stacks are merged and negligible
+    stacks are pruned according to min_count, min_percent and max_stacks. Otherwise there
+    is one line per trace. Return a list of lines. Traces without stack are skipped.
     """
+    if merge or min_count or min_percent or max_stacks is not None:
+        folded_stacks = prune_stacks(get_folded_stacks(stacks, counts), min_count, min_percent, max_stacks)
+        return ['{0} {1}'.format(stack, count) for (stack, count) in folded_stacks.items()]
+
     lines = []
     for id in counts:
+        if id not in stacks:
+            continue
         stack = ";".join(reversed(stacks[id]))
         count = counts[id]
         lines.append('{0} {1}'.format(stack, count))
@@ -178,26 +324,66 @@ def main(argv=None, out=sys.stdout):
     parser.add_argument('--discard-lineno', dest='discard_lineno', action='store_true', help='Remove line numbers')
     parser.add_argument('--discard-thread', dest='discard_thread', action='store_true', help='Remove thread information')
     parser.add_argument('--shorten-pkgs', dest='shorten_pkgs', action='store_true', help='Shorten package names')
+    parser.add_argument('--sites', dest='sites', metavar='WEIGHT', choices=SITE_WEIGHTS,
+                        help='Output the allocation sites weighted by WEIGHT instead of the CPU samples: '
+                             'one of {0}'.format(', '.join(SITE_WEIGHTS)))
+    add_filter_arguments(parser)
+    add_pruning_arguments(parser)
+    add_format_argument(parser)
 
     args = parser.parse_args(argv)
     filename = args.hprof_file[0]
-    content  = get_file_content(filename)
-
-    if not header_match(content):
-        sys.exit('{0} is not an hprof file'.format(filename))
-
-    if is_tracing(content):
-        sys.exit('CPU tracing is not supported. Please use sampling.')
-
-    stacks = get_stacks(content, args.discard_lineno, args.discard_thread, args.shorten_pkgs)
-    if not stacks:
-        sys.exit('Failed to get TRACE')
-
-    counts = get_counts(content)
-    if not counts:
-        sys.exit('Failed to get samples.')
+    content  = map_file(filename)
+
+    try:
+        if not header_match(content):
+            sys.exit('{0} is not an hprof file'.format(filename))
+
+        if not args.sites and is_tracing(content):
+            sys.exit('CPU tracing is not supported. Please use sampling.')
+
+        if not has_traces(content):
+            sys.exit('Failed to get TRACE')
+
+        # The filters may discard every stack, the output is then empty
+        stack_filter = get_stack_filter(args, get_frame_method, lambda method: method)
+        # In sites mode, the filter also applies to the allocated class added by get_allocation_stacks
+        stacks = get_stacks(content, args.discard_lineno, args.discard_thread, args.shorten_pkgs,
+                            None if args.sites else stack_filter)
+
+        if args.sites:
+            sites = get_sites(content)
+            if not sites:
+                sys.exit('Failed to get sites.')
+        else:
+            counts = get_counts(content)
+            if not counts:
+                sys.exit('Failed to get samples.')
+    finally:
+        if isinstance(content, mmap.mmap):
+            content.close()
+
+    if args.format == 'speedscope':
+        if args.sites:
+            folded_stacks = get_allocation_stacks(stacks, sites, args.sites, args.shorten_pkgs, stack_filter)
+        else:
+            folded_stacks = get_folded_stacks(stacks, counts)
+        folded_stacks = prune_stacks(folded_stacks, args.min_count, args.min_percent, args.max_stacks)
+        sorted_stacks = ((stack, folded_stacks[stack]) for stack in sorted(folded_stacks))
+        unit = 'bytes' if args.sites in ('alloc_bytes', 'live_bytes') else 'none'
+        write_speedscope(sorted_stacks, out, name=os.path.basename(filename), unit=unit)
+        return 0
+
+    if args.sites:
+        folded_stacks = get_allocation_stacks(stacks, sites, args.sites, args.shorten_pkgs, stack_filter)
+        folded_stacks = prune_stacks(folded_stacks, args.min_count, args.min_percent, args.max_stacks)
+        lines = ['{0} {1}'.format(stack, weight) for (stack, weight) in folded_stacks.items()]
+    else:
+        # Filtered traces often end up with the same stack
+        lines = to_flamegraph(stacks, counts, args.min_count, args.min_percent, args.max_stacks,
+                              merge=stack_filter is not None)
 
-    for line in to_flamegraph(stacks, counts):
+    for line in lines:
         print(line, file=out)
 
     return 0
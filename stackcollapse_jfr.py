@@ -0,0 +1,499 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2014, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Convert Java Flight Recorder (JFR) recordings into flame graph collapsed stacks.
+
+Only jdk.ExecutionSample events are used. The recording is processed one chunk at
+a time: the metadata and the constant pools of a chunk are loaded, its samples are
+aggregated by stack trace and resolved into folded stacks before the next chunk is
+read.
+
+Usage example:
+::
+    java -XX:StartFlightRecording=filename=recording.jfr,settings=profile [...]
+    stackcollapse-jfr recording.jfr | flamegraph.pl > graph.svg
+
+"""
+
+from __future__ import print_function
+
+import collections
+import os
+import struct
+import sys
+
+from stackcollapse_common import (abbreviate_package, add_filter_arguments, add_format_argument, add_pruning_arguments,
+                                  get_stack_filter, prune_stacks, write_speedscope)
+
+MAGIC = b'FLR\0'
+CHUNK_HEADER = struct.Struct('>4sHHqqqqqqqi')
+COMPRESSED_INTS = 1
+
+METADATA_EVENT = 0
+CONSTANT_POOL_EVENT = 1
+EXECUTION_SAMPLE = 'jdk.ExecutionSample'
+
+# Constant pools needed to resolve the samples, the other ones are skipped
+RESOLVED_POOLS = frozenset([
+    'java.lang.String',
+    'java.lang.Thread',
+    'java.lang.Class',
+    'jdk.types.Method',
+    'jdk.types.Symbol',
+    'jdk.types.StackTrace',
+])
+
+ChunkHeader = collections.namedtuple('ChunkHeader', [
+    'major', 'minor', 'size', 'constant_pool_offset', 'metadata_offset', 'features'])
+Type = collections.namedtuple('Type', ['id', 'name', 'fields'])
+Field = collections.namedtuple('Field', ['name', 'type_id', 'constant_pool', 'array'])
+
+
+try:
+    unichr
+except NameError:  # Python 3
+    unichr = chr
+
+
+class StringRef(object):
+    """ A string stored in the java.lang.String constant pool"""
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
+class ChunkReader(object):
+    """ Decode the primitive values of a chunk held in a bytearray"""
+
+    def __init__(self, data, compressed):
+        self.data = data
+        self.position = 0
+        if not compressed:
+            self.read_int = self._read_fixed_int
+            self.read_long = self._read_fixed_long
+            self.read_short = self._read_fixed_short
+            self.read_char = self._read_fixed_short
+
+    def _read_varlong(self):
+        data = self.data
+        position = self.position
+        result = 0
+        for shift in range(0, 56, 7):
+            byte = data[position]
+            position += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                self.position = position
+                return result
+        # The ninth byte uses all its bits
+        result |= data[position] << 56
+        self.position = position + 1
+        return result
+
+    def read_long(self):
+        value = self._read_varlong()
+        return value - (1 << 64) if value >= (1 << 63) else value
+
+    def read_int(self):
+        value = self._read_varlong() & 0xffffffff
+        return value - (1 << 32) if value >= (1 << 31) else value
+
+    def read_short(self):
+        value = self._read_varlong() & 0xffff
+        return value - (1 << 16) if value >= (1 << 15) else value
+
+    def read_char(self):
+        return self._read_varlong() & 0xffff
+
+    def _unpack(self, fmt, size):
+        (value,) = struct.unpack_from(fmt, self.data, self.position)
+        self.position += size
+        return value
+
+    def _read_fixed_long(self):
+        return self._unpack('>q', 8)
+
+    def _read_fixed_int(self):
+        return self._unpack('>i', 4)
+
+    def _read_fixed_short(self):
+        return self._unpack('>h', 2)
+
+    def read_byte(self):
+        return self._unpack('>b', 1)
+
+    def read_boolean(self):
+        return self._unpack('>?', 1)
+
+    def read_float(self):
+        return self._unpack('>f', 4)
+
+    def read_double(self):
+        return self._unpack('>d', 8)
+
+    def read_string(self):
+        encoding = self.data[self.position]
+        self.position += 1
+        if encoding == 0:
+            return None
+        elif encoding == 1:
+            return ''
+        elif encoding == 2:
+            return StringRef(self.read_long())
+        elif encoding == 3 or encoding == 5:
+            length = self.read_int()
+            raw = self.data[self.position:self.position + length]
+            self.position += length
+            return raw.decode('utf-8' if encoding == 3 else 'latin-1')
+        elif encoding == 4:
+            length = self.read_int()
+            return ''.join([unichr(self.read_char()) for _ in range(length)])
+        else:
+            raise Exception("Unexpected string encoding: %s at offset %s" % (encoding, self.position - 1))
+
+
+def parse_chunk_header(data):
+    """ Parse the header of the chunk starting at the beginning of data"""
+    fields = CHUNK_HEADER.unpack_from(data)
+    if fields[0] != MAGIC:
+        raise Exception("Not a JFR chunk: bad magic %r" % fields[0])
+    (_, major, minor, size, constant_pool_offset, metadata_offset) = fields[:6]
+    return ChunkHeader(major, minor, size, constant_pool_offset, metadata_offset, fields[-1])
+
+
+def _read_element(reader, strings):
+    """ Read a metadata element as a (name, attributes, children) tuple"""
+    name = strings[reader.read_int()]
+    attributes = {}
+    for _ in range(reader.read_int()):
+        key = strings[reader.read_int()]
+        attributes[key] = strings[reader.read_int()]
+    children = [_read_element(reader, strings) for _ in range(reader.read_int())]
+    return name, attributes, children
+
+
+def _iter_elements(element, name):
+    if element[0] == name:
+        yield element
+    for child in element[2]:
+        for match in _iter_elements(child, name):
+            yield match
+
+
+def parse_metadata(reader, offset):
+    """ Parse the metadata event at offset. Return a dict of Type indexed by type id."""
+    reader.position = offset
+    reader.read_int()  # size
+    if reader.read_long() != METADATA_EVENT:
+        raise Exception("Expected a metadata event at offset %s" % offset)
+    reader.read_long()  # start time
+    reader.read_long()  # duration
+    reader.read_long()  # metadata id
+
+    strings = [reader.read_string() for _ in range(reader.read_int())]
+    root = _read_element(reader, strings)
+
+    types = {}
+    for (_, attributes, children) in _iter_elements(root, 'class'):
+        fields = [
+            Field(field_attributes['name'],
+                  int(field_attributes['class']),
+                  field_attributes.get('constantPool') == 'true',
+                  field_attributes.get('dimension') == '1')
+            for (child_name, field_attributes, _) in children if child_name == 'field'
+        ]
+        type_id = int(attributes['id'])
+        types[type_id] = Type(type_id, attributes['name'], fields)
+    return types
+
+
+class ValueParser(object):
+    """ Build and cache a decoding function for each type described by the metadata"""
+
+    PRIMITIVES = {
+        'boolean': 'read_boolean',
+        'byte': 'read_byte',
+        'char': 'read_char',
+        'short': 'read_short',
+        'int': 'read_int',
+        'long': 'read_long',
+        'float': 'read_float',
+        'double': 'read_double',
+        'java.lang.String': 'read_string',
+    }
+
+    def __init__(self, reader, types):
+        self.reader = reader
+        self.types = types
+        self._parsers = {}
+
+    def get(self, type_id):
+        """ Return a function reading a value of type_id. Objects are read as dicts indexed by field name."""
+        parser = self._parsers.get(type_id)
+        if parser is None:
+            value_type = self.types[type_id]
+            if value_type.name in self.PRIMITIVES:
+                parser = getattr(self.reader, self.PRIMITIVES[value_type.name])
+            else:
+                # Register a placeholder first, types can be recursive
+                self._parsers[type_id] = lambda: parser()
+                parser = self._object_parser(value_type)
+            self._parsers[type_id] = parser
+        return parser
+
+    def _object_parser(self, value_type):
+        reader = self.reader
+        field_parsers = []
+        for field in value_type.fields:
+            parser = reader.read_long if field.constant_pool else self.get(field.type_id)
+            if field.array:
+                parser = self._array_parser(parser)
+            field_parsers.append((field.name, parser))
+
+        def parse_object():
+            return dict((name, parser()) for (name, parser) in field_parsers)
+        return parse_object
+
+    def _array_parser(self, parser):
+        reader = self.reader
+
+        def parse_array():
+            return [parser() for _ in range(reader.read_int())]
+        return parse_array
+
+
+def parse_constant_pools(reader, values, offset):
+    """ Parse the chain of constant pool events starting at offset.
+
+    Return a dict of pools indexed by type name. Only the RESOLVED_POOLS are kept.
+    """
+    types_by_id = values.types
+    pools = collections.defaultdict(dict)
+    while True:
+        reader.position = offset
+        reader.read_int()  # size
+        if reader.read_long() != CONSTANT_POOL_EVENT:
+            raise Exception("Expected a constant pool event at offset %s" % offset)
+        reader.read_long()  # start time
+        reader.read_long()  # duration
+        delta = reader.read_long()
+        reader.read_byte()  # flush / checkpoint type
+
+        for _ in range(reader.read_int()):
+            type_id = reader.read_long()
+            parser = values.get(type_id)
+            pool = pools[types_by_id[type_id].name] if types_by_id[type_id].name in RESOLVED_POOLS else None
+            for _ in range(reader.read_int()):
+                key = reader.read_long()
+                value = parser()
+                if pool is not None:
+                    pool[key] = value
+
+        if delta == 0:
+            return pools
+        offset += delta
+
+
+def parse_chunk(data, header):
+    """ Aggregate the execution samples of a chunk.
+
+    Return the constant pools of the chunk and a dict of sample counts indexed by
+    (thread key, stack trace key).
+    """
+    reader = ChunkReader(data, header.major >= 2 and header.features & COMPRESSED_INTS)
+    types = parse_metadata(reader, header.metadata_offset)
+    values = ValueParser(reader, types)
+    pools = parse_constant_pools(reader, values, header.constant_pool_offset)
+
+    samples = collections.defaultdict(int)
+    sample_type = [t for t in types.values() if t.name == EXECUTION_SAMPLE]
+    if not sample_type:
+        return pools, samples
+    sample_type_id = sample_type[0].id
+    parse_sample = values.get(sample_type_id)
+
+    position = CHUNK_HEADER.size
+    while position < header.size:
+        reader.position = position
+        size = reader.read_int()
+        if size <= 0:
+            raise Exception("Invalid event size %s at offset %s" % (size, position))
+        if reader.read_long() == sample_type_id:
+            sample = parse_sample()
+            samples[(sample.get('sampledThread'), sample.get('stackTrace'))] += 1
+        position += size
+
+    return pools, samples
+
+
+def iter_chunks(filename):
+    """ Yield a (header, data) tuple for each chunk of a JFR file. Only one chunk is held in memory."""
+    with open(filename, 'rb') as fh:
+        while True:
+            raw_header = fh.read(CHUNK_HEADER.size)
+            if not raw_header:
+                break
+            if len(raw_header) < CHUNK_HEADER.size:
+                raise Exception("Truncated chunk header at offset %s" % (fh.tell() - len(raw_header)))
+            header = parse_chunk_header(raw_header)
+            data = bytearray(raw_header)
+            data.extend(fh.read(header.size - CHUNK_HEADER.size))
+            if len(data) < header.size:
+                raise Exception("Truncated chunk: expected %s bytes, got %s" % (header.size, len(data)))
+            yield header, data
+
+
+class MissingConstantError(Exception):
+    """ A constant pool reference which is not defined in its chunk"""
+
+    def __init__(self, pool, key):
+        super(MissingConstantError, self).__init__("Missing %s %s in the constant pool" % (pool, key))
+        self.pool = pool
+        self.key = key
+
+
+class ChunkResolver(object):
+    """ Resolve the constant pool references of a chunk into readable names"""
+
+    def __init__(self, pools, shorten_pkgs):
+        self.pools = pools
+        self.shorten_pkgs = shorten_pkgs
+        self._method_names = {}
+
+    def string(self, value):
+        if isinstance(value, StringRef):
+            value = self.pools['java.lang.String'].get(value.index)
+        return value or ''
+
+    def symbol(self, key):
+        symbol = self.pools['jdk.types.Symbol'].get(key)
+        return self.string(symbol['string']) if symbol else ''
+
+    def method_name(self, key):
+        """ Return the package.Class.method name of a method"""
+        method_name = self._method_names.get(key)
+        if method_name is None:
+            method = self.pools['jdk.types.Method'].get(key)
+            if method is None:
+                raise MissingConstantError('jdk.types.Method', key)
+            klass = self.pools['java.lang.Class'].get(method.get('type'), {})
+            class_name = self.symbol(klass.get('name')).replace('/', '.')
+            if self.shorten_pkgs:
+                class_name = abbreviate_package(class_name)
+            method_name = self._method_names[key] = '%s.%s' % (class_name, self.symbol(method.get('name')))
+        return method_name
+
+    def thread_name(self, key):
+        thread = self.pools['java.lang.Thread'].get(key, {})
+        return 'Thread %s' % (thread.get('javaThreadId') or thread.get('osThreadId') or key)
+
+    def frames(self, key):
+        """ Return the (method name, line number) frames of a stack trace, ordered from the leaf to the root"""
+        stack_trace = self.pools['jdk.types.StackTrace'].get(key)
+        if stack_trace is None:
+            raise MissingConstantError('jdk.types.StackTrace', key)
+        return [(self.method_name(frame['method']), frame.get('lineNumber'))
+                for frame in stack_trace.get('frames', [])]
+
+
+def format_frame(frame, discard_lineno):
+    (method_name, line_no) = frame
+    if not discard_lineno and line_no and line_no > 0:
+        return '%s:%s' % (method_name, line_no)
+    return method_name
+
+
+def iter_stacks(filename, discard_lineno=False, shorten_pkgs=False, stack_filter=None):
+    """ Yield a (thread name, frames, sample count) tuple for each distinct stack trace of each chunk.
+
+    Frames are formatted and ordered from the leaf to the root. Stack traces referring to
+    constants missing from their chunk are skipped with a message on stderr.
+    """
+    for (header, data) in iter_chunks(filename):
+        (pools, samples) = parse_chunk(data, header)
+
+        resolver = ChunkResolver(pools, shorten_pkgs)
+        for ((thread_key, stack_trace_key), count) in samples.items():
+            if stack_trace_key is None:
+                continue
+            try:
+                frames = resolver.frames(stack_trace_key)
+            except MissingConstantError as e:
+                sys.stderr.write("skipped stack trace %s: %s\n" % (stack_trace_key, e))
+                continue
+            if stack_filter:
+                frames = stack_filter(frames)
+            if not frames:
+                continue
+
+            frames = [format_frame(frame, discard_lineno) for frame in frames]
+            yield resolver.thread_name(thread_key), frames, count
+
+
+def main(argv=None, out=sys.stdout):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert a JFR recording into Flamegraph collapsed stacks')
+    parser.add_argument('jfr_file', metavar='FILE', type=str, nargs=1, help='A JFR recording')
+    parser.add_argument('--discard-lineno', dest='discard_lineno', action='store_true', help='Remove line numbers')
+    parser.add_argument('--discard-thread', dest='discard_thread', action='store_true', help='Remove thread info')
+    parser.add_argument('--shorten-pkgs', dest='shorten_pkgs', action='store_true', help='Shorten package names')
+    add_filter_arguments(parser)
+    add_pruning_arguments(parser)
+    add_format_argument(parser)
+
+    args = parser.parse_args(argv)
+    filename = args.jfr_file[0]
+
+    stack_filter = get_stack_filter(args, lambda frame: frame[0], lambda method_name: method_name)
+
+    folded_stacks = collections.defaultdict(int)
+
+    for (thread_name, frames, count) in iter_stacks(filename, args.discard_lineno, args.shorten_pkgs, stack_filter):
+        if not args.discard_thread:
+            frames.append(thread_name)
+
+        folded_stack = ';'.join(reversed(frames))
+        folded_stacks[folded_stack] += count
+
+    folded_stacks = prune_stacks(folded_stacks, args.min_count, args.min_percent, args.max_stacks)
+
+    if args.format == 'speedscope':
+        sorted_stacks = ((folded_stack, folded_stacks[folded_stack]) for folded_stack in sorted(folded_stacks))
+        write_speedscope(sorted_stacks, out, name=os.path.basename(filename))
+        return 0
+
+    for folded_stack in sorted(folded_stacks):
+        sample_count = folded_stacks[folded_stack]
+        print("%s %s" % (folded_stack, sample_count), file=out)
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2014, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Serve flame graph collapsed stacks from profiles kept in memory.
+
+HPROF, honest-profiler and JFR files are parsed once, on first use, and their samples
+are kept in memory as interned frame and stack tables. The least recently used
+profiles are evicted when the cache exceeds its size. Views are computed on demand
+from the in memory tables. Parsing and views run in a thread pool, so requests on
+loaded profiles are served while another profile is being parsed.
+
+Requires Python >= 3.5.
+
+Usage example:
+::
+    stackcollapse-server --port 8000 /path/to/profiles
+    curl 'http://localhost:8000/folded?file=log.hpl&discard_lineno=1' | flamegraph.pl > graph.svg
+    curl 'http://localhost:8000/top?file=log.hpl&n=10'
+
+Endpoints:
+::
+    /folded    collapsed stacks of a profile
+    /top       JSON report of the methods with the most self samples
+    /profiles  JSON list of the profiles held in memory
+
+The file parameter is a path relative to the served directory. /folded and /top
+accept the options of the command line scripts as parameters (discard_lineno,
+discard_thread, shorten_pkgs, include, exclude, root, max_depth, collapse_recursion,
+min_count, min_percent, max_stacks) and a time window in seconds from the first
+sample (start, end) for the timestamped honest-profiler logs.
+"""
+
+import argparse
+import array
+import asyncio
+import bisect
+import collections
+import json
+import mmap
+import os
+import re
+import sys
+from urllib.parse import parse_qs, urlsplit
+
+import stackcollapse_hpl
+import stackcollapse_hprof
+import stackcollapse_jfr
+from stackcollapse_common import abbreviate_package, get_stack_filter, positive_int, prune_stacks
+
+FLAGS = ('discard_lineno', 'discard_thread', 'shorten_pkgs', 'collapse_recursion')
+LISTS = ('include', 'exclude')
+VALUES = {
+    'root': str,
+    'max_depth': positive_int,
+    'min_count': int,
+    'min_percent': float,
+    'max_stacks': positive_int,
+    'start': float,
+    'end': float,
+}
+
+
+class HttpError(Exception):
+    """ An error reported to the client with an HTTP status"""
+
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+class Profile(object):
+    """ The samples of a profile, with interned frames and stacks.
+
+    Frames keep all the available information (line numbers, full package names and
+    threads). It is discarded when a view is computed. file_type is the format of the
+    profile, as returned by get_file_type.
+    """
+
+    def __init__(self, path, file_type):
+        self.path = path
+        self.file_type = file_type
+        self.frames = []
+        self._frame_ids = {}
+        # (thread frame id or -1, tuple of frame ids from the leaf to the root)
+        self.stacks = []
+        self._stack_ids = {}
+        self.counts = array.array('l')
+        # Timestamped samples, sorted by time once the profile is loaded
+        self.times = array.array('d')
+        self.time_stacks = array.array('l')
+        # Estimated memory use in bytes, computed once by finish()
+        self.size = 0
+
+    def _intern_frame(self, frame):
+        frame_id = self._frame_ids.get(frame)
+        if frame_id is None:
+            frame_id = self._frame_ids[frame] = len(self.frames)
+            self.frames.append(frame)
+        return frame_id
+
+    def add(self, thread, frames, count=1, time=None):
+        """ Add count samples of a stack. frames are ordered from the leaf to the root."""
+        thread_id = self._intern_frame(thread) if thread else -1
+        key = (thread_id, tuple([self._intern_frame(frame) for frame in frames]))
+        stack_id = self._stack_ids.get(key)
+        if stack_id is None:
+            stack_id = self._stack_ids[key] = len(self.stacks)
+            self.stacks.append(key)
+            self.counts.append(0)
+        self.counts[stack_id] += count
+        if time is not None:
+            self.times.append(time)
+            self.time_stacks.append(stack_id)
+
+    def finish(self):
+        """ Sort the timestamped samples, release the interning tables and compute the size"""
+        if self.times:
+            order = sorted(range(len(self.times)), key=self.times.__getitem__)
+            self.times = array.array('d', [self.times[i] for i in order])
+            self.time_stacks = array.array('l', [self.time_stacks[i] for i in order])
+        self._frame_ids = None
+        self._stack_ids = None
+        self.size = self._estimate_size()
+        return self
+
+    @property
+    def samples(self):
+        return sum(self.counts)
+
+    def _estimate_size(self):
+        """ Rough estimate of the memory used by the profile, in bytes"""
+        size = sum(len(frame) + 80 for frame in self.frames)
+        size += sum(8 * len(frames) + 120 for (_, frames) in self.stacks)
+        size += self.counts.itemsize * len(self.counts)
+        size += (self.times.itemsize + self.time_stacks.itemsize) * len(self.times)
+        return size
+
+    def get_counts(self, start=None, end=None):
+        """ Return the sample counts indexed by stack id, within [start, end) seconds from the first sample"""
+        if start is None and end is None:
+            return dict(enumerate(self.counts))
+
+        if not self.times:
+            raise HttpError(400, 'No timestamp in %s' % self.path)
+        origin = self.times[0]
+        low = 0 if start is None else bisect.bisect_left(self.times, origin + start)
+        high = len(self.times) if end is None else bisect.bisect_left(self.times, origin + end)
+        counts = collections.defaultdict(int)
+        for stack_id in self.time_stacks[low:high]:
+            counts[stack_id] += 1
+        return counts
+
+
+def get_file_type(path):
+    """ Return 'jfr', 'hprof' or 'hpl' according to the first bytes of a file"""
+    with open(path, 'rb') as fh:
+        head = fh.read(12)
+    if head.startswith(stackcollapse_jfr.MAGIC):
+        return 'jfr'
+    if head.startswith(b'JAVA PROFILE'):
+        return 'hprof'
+    return 'hpl'
+
+
+def load_profile(path):
+    """ Parse a HPROF, honest-profiler or JFR file into a Profile"""
+    file_type = get_file_type(path)
+    profile = Profile(path, file_type)
+    if file_type == 'hprof':
+        content = stackcollapse_hprof.map_file(path)
+        try:
+            if stackcollapse_hprof.is_tracing(content):
+                raise HttpError(400, 'CPU tracing is not supported. Please use sampling.')
+            stacks = stackcollapse_hprof.get_stacks(content)
+            counts = stackcollapse_hprof.get_counts(content)
+        finally:
+            if isinstance(content, mmap.mmap):
+                content.close()
+        for (trace_id, count) in counts.items():
+            stack = stacks.get(trace_id)
+            if not stack:
+                continue
+            thread = stack[-1] if stack[-1].startswith('Thread ') else None
+            profile.add(thread, stack[:-1] if thread else stack, int(count))
+    elif file_type == 'hpl':
+        (traces, methods) = stackcollapse_hpl.parse_hpl(path)
+        trace_frames = stackcollapse_hpl.iter_trace_frames(traces, methods, skip_trace_on_missing_frame=True)
+        for (trace, frames) in trace_frames:
+            profile.add('Thread %s' % trace.thread_id, frames, time=trace.time)
+    else:
+        for (thread, frames, count) in stackcollapse_jfr.iter_stacks(path):
+            profile.add(thread, frames, count)
+    return profile.finish()
+
+
+def parse_view_options(query):
+    """ Convert query parameters into the options understood by get_folded_stacks"""
+    options = argparse.Namespace(**dict((name, False) for name in FLAGS))
+    for name in LISTS:
+        setattr(options, name, query.get(name))
+    for name in VALUES:
+        setattr(options, name, None)
+    options.min_count = 0
+    options.min_percent = 0.0
+
+    for name in FLAGS:
+        if name in query:
+            setattr(options, name, query[name][-1].lower() not in ('0', 'false', 'no', ''))
+    for (name, value_type) in VALUES.items():
+        if name in query:
+            try:
+                setattr(options, name, value_type(query[name][-1]))
+            except (ValueError, argparse.ArgumentTypeError):
+                raise HttpError(400, 'Invalid value for %s: %s' % (name, query[name][-1]))
+    for name in LISTS + ('root',):
+        for pattern in query.get(name, []):
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise HttpError(400, 'Invalid regular expression for %s: %s' % (name, e))
+    return options
+
+
+def abbreviate_class_package(frame):
+    """ Abbreviate the package of the class of a frame: foo.bar.Class.method -> f.bar.Class.method
+
+    The honest-profiler and JFR scripts only abbreviate the class name, unlike the HPROF
+    one which abbreviates the whole frame.
+    """
+    (class_name, dot, method_name) = frame.rpartition('.')
+    if not dot:
+        return frame
+    return '%s.%s' % (abbreviate_package(class_name), method_name)
+
+
+def get_folded_stacks(profile, options):
+    """ Compute a view of a profile. Return a dict of sample counts indexed by folded stack."""
+    names = {}
+
+    def get_name(frame_id):
+        name = names.get(frame_id)
+        if name is None:
+            name = profile.frames[frame_id]
+            if options.discard_lineno:
+                name = stackcollapse_hprof.get_frame_method(name)
+            if options.shorten_pkgs and profile.file_type == 'hprof':
+                name = abbreviate_package(name)
+            elif options.shorten_pkgs:
+                name = abbreviate_class_package(name)
+            names[frame_id] = name
+        return name
+
+    stack_filter = get_stack_filter(
+        options,
+        lambda frame_id: frame_id,
+        lambda frame_id: stackcollapse_hprof.get_frame_method(get_name(frame_id))
+    )
+
+    folded_stacks = collections.defaultdict(int)
+    for (stack_id, count) in profile.get_counts(options.start, options.end).items():
+        if not count:
+            continue
+        (thread_id, frame_ids) = profile.stacks[stack_id]
+        if stack_filter:
+            frame_ids = stack_filter(frame_ids)
+            if not frame_ids:
+                continue
+
+        frames = [get_name(frame_id) for frame_id in reversed(frame_ids)]
+        if thread_id >= 0 and not options.discard_thread:
+            frames.insert(0, get_name(thread_id))
+        folded_stacks[';'.join(frames)] += count
+
+    return prune_stacks(folded_stacks, options.min_count, options.min_percent, options.max_stacks)
+
+
+def get_folded_text(profile, options):
+    """ Compute a view of a profile as collapsed stacks sorted like the scripts output them"""
+    folded_stacks = get_folded_stacks(profile, options)
+    return ''.join('%s %s\n' % (stack, folded_stacks[stack]) for stack in sorted(folded_stacks))
+
+
+def get_top_methods(profile, options, limit):
+    """ Return the methods with the most self samples as a list of dict"""
+    options = argparse.Namespace(**vars(options))
+    options.discard_thread = True
+
+    self_counts = collections.defaultdict(int)
+    total_counts = collections.defaultdict(int)
+    for (folded_stack, count) in get_folded_stacks(profile, options).items():
+        frames = folded_stack.split(';')
+        self_counts[frames[-1]] += count
+        for frame in set(frames):
+            total_counts[frame] += count
+
+    top = sorted(total_counts, key=lambda frame: (-self_counts[frame], -total_counts[frame], frame))[:limit]
+    return [{'name': frame, 'self': self_counts[frame], 'total': total_counts[frame]} for frame in top]
+
+
+class ProfileCache(object):
+    """ LRU cache of the loaded profiles, bounded by their estimated size in bytes"""
+
+    def __init__(self, max_size, loop=None):
+        self.max_size = max_size
+        self.loop = loop
+        self.size = 0
+        self._profiles = collections.OrderedDict()
+        self._loading = {}
+
+    def __iter__(self):
+        return iter(self._profiles.values())
+
+    def get(self, path):
+        """ Return a future of the profile of path. Concurrent requests share the same parsing."""
+        stat = os.stat(path)
+        key = (path, stat.st_mtime, stat.st_size)
+
+        profile = self._profiles.get(key)
+        if profile is not None:
+            self._profiles.move_to_end(key)
+            future = self.loop.create_future()
+            future.set_result(profile)
+            return future
+
+        future = self._loading.get(key)
+        if future is None:
+            future = self.loop.run_in_executor(None, load_profile, path)
+            future.add_done_callback(lambda done: self._loaded(key, done))
+            self._loading[key] = future
+        return asyncio.shield(future)
+
+    def _loaded(self, key, future):
+        del self._loading[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        for stale_key in [k for k in self._profiles if k[0] == key[0]]:
+            self.size -= self._profiles.pop(stale_key).size
+        profile = future.result()
+        self._profiles[key] = profile
+        self.size += profile.size
+        while self.size > self.max_size and len(self._profiles) > 1:
+            (_, evicted) = self._profiles.popitem(last=False)
+            self.size -= evicted.size
+
+
+class ProfileServer(object):
+    """ Minimal HTTP/1.0 server exposing the views of the cached profiles"""
+
+    def __init__(self, directory, cache_size, loop=None):
+        self.directory = os.path.realpath(directory)
+        self.loop = loop or asyncio.get_event_loop()
+        self.cache = ProfileCache(cache_size, self.loop)
+
+    def start(self, host='127.0.0.1', port=8000):
+        """ Return a coroutine starting the server"""
+        return asyncio.start_server(self.handle, host, port)
+
+    def resolve(self, query):
+        names = query.get('file')
+        if not names:
+            raise HttpError(400, 'Missing file parameter')
+        path = os.path.realpath(os.path.join(self.directory, names[-1]))
+        if os.path.commonprefix([path, self.directory + os.sep]) != self.directory + os.sep:
+            raise HttpError(403, 'Forbidden file: %s' % names[-1])
+        if not os.path.isfile(path):
+            raise HttpError(404, 'No such file: %s' % names[-1])
+        return path
+
+    async def dispatch(self, method, target):
+        """ Return the (status, content type, body) response of a request"""
+        if method != 'GET':
+            raise HttpError(405, 'Method not allowed: %s' % method)
+
+        url = urlsplit(target)
+        query = parse_qs(url.query, keep_blank_values=True)
+
+        if url.path == '/profiles':
+            profiles = [{'file': os.path.relpath(profile.path, self.directory),
+                         'samples': profile.samples,
+                         'size': profile.size} for profile in self.cache]
+            return 200, 'application/json', json.dumps(profiles)
+
+        if url.path not in ('/folded', '/top'):
+            raise HttpError(404, 'Not found: %s' % url.path)
+
+        options = parse_view_options(query)
+        profile = await self.cache.get(self.resolve(query))
+
+        if url.path == '/folded':
+            body = await self.loop.run_in_executor(None, get_folded_text, profile, options)
+            return 200, 'text/plain; charset=utf-8', body
+
+        try:
+            limit = int(query.get('n', ['20'])[-1])
+        except ValueError:
+            raise HttpError(400, 'Invalid value for n: %s' % query['n'][-1])
+        top = await self.loop.run_in_executor(None, get_top_methods, profile, options, limit)
+        return 200, 'application/json', json.dumps(top)
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass  # Headers are ignored
+
+            try:
+                (method, target) = request_line.split()[:2]
+                (status, content_type, body) = await self.dispatch(method, target)
+            except HttpError as e:
+                (status, content_type, body) = (e.status, 'text/plain; charset=utf-8', '%s\n' % e)
+            except ValueError:
+                (status, content_type, body) = (400, 'text/plain; charset=utf-8', 'Bad request\n')
+            except Exception as e:
+                (status, content_type, body) = (500, 'text/plain; charset=utf-8', '%s\n' % e)
+
+            body = body.encode('utf-8')
+            writer.write(('HTTP/1.0 %s %s\r\n'
+                          'Content-Type: %s\r\n'
+                          'Content-Length: %s\r\n'
+                          'Connection: close\r\n\r\n' % (status, REASONS.get(status, ''), content_type, len(body))
+                          ).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve Flamegraph collapsed stacks from profiles kept in memory')
+    parser.add_argument('directory', metavar='DIR', nargs='?', default='.', help='Directory of the profiles to serve')
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', dest='port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--cache-size', dest='cache_size', metavar='MB', type=int, default=1024,
+                        help='Memory budget of the loaded profiles, in megabytes')
+
+    args = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = ProfileServer(args.directory, args.cache_size * 1024 * 1024, loop)
+    loop.run_until_complete(server.start(args.host, args.port))
+    sys.stderr.write('Serving %s on http://%s:%s/\n' % (server.directory, args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
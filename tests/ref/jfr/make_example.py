@@ -0,0 +1,293 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write example.jfr, the JFR recording used by test_jfr.py.
+
+The recording is built from the JFR 2.0 chunk layout rather than recorded by a JVM,
+so that the expected stacks are known and the file stays small. It has two chunks:
+
+- the first one holds all its constant pools in a single event, a string pool
+  reference (the thread name) and a jdk.CPULoad event which must be skipped,
+- the second one uses different constant pool keys and splits its pools in two
+  chained constant pool events.
+
+Events and constant pools use compressed integers. Sizes are written as 4 bytes
+padded varints, like the JDK does.
+
+Usage:
+::
+    python tests/ref/jfr/make_example.py
+"""
+
+import os
+import struct
+
+# id, name, super type, fields as (name, type id, constant pool, array)
+TYPES = [
+    (1, 'long', None, []),
+    (2, 'int', None, []),
+    (3, 'byte', None, []),
+    (4, 'boolean', None, []),
+    (5, 'float', None, []),
+    (20, 'java.lang.String', None, []),
+    (31, 'java.lang.ThreadGroup', None, [('parent', 31, True, False), ('name', 20, False, False)]),
+    (21, 'java.lang.Thread', None, [('osName', 20, False, False), ('osThreadId', 1, False, False),
+                                    ('javaName', 20, False, False), ('javaThreadId', 1, False, False),
+                                    ('group', 31, True, False)]),
+    (30, 'jdk.types.ClassLoader', None, [('type', 22, True, False), ('name', 23, True, False)]),
+    (29, 'jdk.types.Package', None, [('name', 23, True, False)]),
+    (22, 'java.lang.Class', None, [('classLoader', 30, True, False), ('name', 23, True, False),
+                                   ('package', 29, True, False), ('modifiers', 2, False, False)]),
+    (23, 'jdk.types.Symbol', None, [('string', 20, False, False)]),
+    (24, 'jdk.types.Method', None, [('type', 22, True, False), ('name', 23, True, False),
+                                    ('descriptor', 23, True, False), ('modifiers', 2, False, False),
+                                    ('hidden', 4, False, False)]),
+    (27, 'jdk.types.FrameType', None, [('description', 20, False, False)]),
+    (26, 'jdk.types.StackFrame', None, [('method', 24, True, False), ('lineNumber', 2, False, False),
+                                        ('bytecodeIndex', 2, False, False), ('type', 27, True, False)]),
+    (25, 'jdk.types.StackTrace', None, [('truncated', 4, False, False), ('frames', 26, False, True)]),
+    (28, 'jdk.types.ThreadState', None, [('name', 20, False, False)]),
+    (101, 'jdk.ExecutionSample', 'jdk.jfr.Event', [('startTime', 1, False, False), ('sampledThread', 21, True, False),
+                                                   ('stackTrace', 25, True, False), ('state', 28, True, False)]),
+    (102, 'jdk.CPULoad', 'jdk.jfr.Event', [('startTime', 1, False, False), ('jvmUser', 5, False, False),
+                                           ('jvmSystem', 5, False, False), ('machineTotal', 5, False, False)]),
+]
+TYPES_BY_ID = dict((type_id, (type_id, name, super_type, fields)) for (type_id, name, super_type, fields) in TYPES)
+
+EXECUTION_SAMPLE = 101
+CPU_LOAD = 102
+HEADER_SIZE = 68
+
+
+class StringRef(object):
+    """ A reference to the java.lang.String constant pool"""
+
+    def __init__(self, index):
+        self.index = index
+
+
+def varlong(value):
+    """ Encode a compressed long: 7 bits per byte, the 9th byte holds 8 bits"""
+    value &= (1 << 64) - 1
+    out = bytearray()
+    for _ in range(8):
+        if value < 0x80:
+            out.append(value)
+            return bytes(out)
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value & 0xff)
+    return bytes(out)
+
+
+def string(value):
+    """ Encode a string: null, empty, constant pool reference or UTF-8"""
+    if value is None:
+        return b'\x00'
+    if value == '':
+        return b'\x01'
+    if isinstance(value, StringRef):
+        return b'\x02' + varlong(value.index)
+    encoded = value.encode('utf-8')
+    return b'\x03' + varlong(len(encoded)) + encoded
+
+
+def sized(body):
+    """ Prefix an event with its size, written as a 4 bytes padded varint including itself"""
+    size = len(body) + 4
+    encoded = bytearray()
+    for _ in range(3):
+        encoded.append((size & 0x7f) | 0x80)
+        size >>= 7
+    encoded.append(size & 0x7f)
+    return bytes(encoded) + body
+
+
+def metadata_event():
+    strings = []
+    string_ids = {}
+
+    def string_id(value):
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    def element(name, attributes, children):
+        out = varlong(string_id(name)) + varlong(len(attributes))
+        for (key, value) in attributes:
+            out += varlong(string_id(key)) + varlong(string_id(value))
+        out += varlong(len(children))
+        for child in children:
+            out += child
+        return out
+
+    classes = []
+    for (type_id, name, super_type, fields) in TYPES:
+        attributes = [('name', name), ('id', str(type_id))]
+        children = []
+        if super_type:
+            attributes.append(('superType', super_type))
+            children.append(element('annotation', [('class', '200'), ('value', name)], []))
+            children.append(element('setting', [('name', 'enabled'), ('class', '4'), ('defaultValue', 'true')], []))
+        for (field_name, field_type, constant_pool, array) in fields:
+            field_attributes = [('name', field_name), ('class', str(field_type))]
+            if constant_pool:
+                field_attributes.append(('constantPool', 'true'))
+            if array:
+                field_attributes.append(('dimension', '1'))
+            field_children = []
+            if field_name == 'startTime':
+                field_children.append(element('annotation', [('class', '201'), ('value', field_name)], []))
+            children.append(element('field', field_attributes, field_children))
+        classes.append(element('class', attributes, children))
+    classes.append(element('class', [('name', 'jdk.jfr.Label'), ('id', '200'),
+                                     ('superType', 'java.lang.annotation.Annotation')], []))
+    classes.append(element('class', [('name', 'jdk.jfr.Timestamp'), ('id', '201'),
+                                     ('superType', 'java.lang.annotation.Annotation')], []))
+    root = element('root', [], [
+        element('metadata', [], classes),
+        element('region', [('locale', 'en_US'), ('gmtOffset', '0')], []),
+    ])
+
+    # type 0, start time, duration, metadata id
+    body = varlong(0) + varlong(1000) + varlong(0) + varlong(1)
+    body += varlong(len(strings)) + b''.join(string(value) for value in strings) + root
+    return sized(body)
+
+
+def value(type_id, data):
+    """ Encode a value of a type, constant pool fields being given by key"""
+    (_, name, _, fields) = TYPES_BY_ID[type_id]
+    if name in ('long', 'int'):
+        return varlong(data)
+    if name == 'boolean':
+        return b'\x01' if data else b'\x00'
+    if name == 'float':
+        return struct.pack('>f', data)
+    if name == 'java.lang.String':
+        return string(data)
+
+    out = b''
+    for (field_name, field_type, constant_pool, array) in fields:
+        field_value = data[field_name]
+        if array:
+            out += varlong(len(field_value))
+            for item in field_value:
+                out += varlong(item) if constant_pool else value(field_type, item)
+        else:
+            out += varlong(field_value) if constant_pool else value(field_type, field_value)
+    return out
+
+
+def event(type_id, data):
+    return sized(varlong(type_id) + value(type_id, data))
+
+
+def constant_pool_event(pools, delta):
+    """ Encode a constant pool event. delta is the offset of the previous one, relative to this one."""
+    # type 1, start time, duration, delta, flush flag
+    body = varlong(1) + varlong(1000) + varlong(0) + varlong(delta) + b'\x00'
+    body += varlong(len(pools))
+    for (type_id, entries) in pools:
+        body += varlong(type_id) + varlong(len(entries))
+        for (key, data) in entries:
+            body += varlong(key) + value(type_id, data)
+    return sized(body)
+
+
+def chunk(events, constant_pools):
+    """ Encode a chunk: header, events, chained constant pool events and metadata"""
+    body = b''.join(events)
+    offset = HEADER_SIZE + len(body)
+
+    pools = b''
+    previous = None
+    for pool in constant_pools:
+        position = offset + len(pools)
+        delta = 0 if previous is None else previous - position
+        pools += constant_pool_event(pool, delta)
+        previous = position
+
+    metadata_offset = offset + len(pools)
+    metadata = metadata_event()
+    size = metadata_offset + len(metadata)
+    # magic, major, minor, size, constant pool offset (last event of the chain), metadata offset,
+    # start nanos, duration nanos, start ticks, ticks per second, features (compressed integers)
+    header = struct.pack('>4sHHqqqqqqqi', b'FLR\0', 2, 0, size, previous, metadata_offset,
+                         0, 1000, 0, 1000000000, 1)
+    return header + body + pools + metadata
+
+
+def method_pools(base):
+    """ Symbols, classes, packages and methods of the example, keys being offset by base"""
+    symbols = [(base + key, {'string': name}) for (key, name) in [
+        (1, 'Example'), (2, 'main'), (3, 'compute'), (4, 'java/util/HashMap'), (5, 'put'), (6, 'fib'),
+        (7, 'work'), (8, 'java/lang/Thread'), (9, 'run'), (10, '()V'), (11, 'example'), (12, 'java/util'),
+    ]]
+    classes = [(base + key, {'classLoader': 0, 'name': base + name, 'package': base + package, 'modifiers': 1})
+               for (key, name, package) in [(1, 1, 1), (2, 4, 2), (3, 8, 2)]]
+    packages = [(base + 1, {'name': base + 11}), (base + 2, {'name': base + 12})]
+    methods = [(base + key, {'type': base + klass, 'name': base + name, 'descriptor': base + 10,
+                             'modifiers': 1, 'hidden': False})
+               for (key, klass, name) in [(1, 1, 2), (2, 1, 3), (3, 2, 5), (4, 1, 6), (5, 1, 7), (6, 3, 9)]]
+    return symbols, classes, packages, methods
+
+
+def stack_trace(base, frames):
+    """ A stack trace of (method key, line number) frames, ordered from the leaf to the root"""
+    return {'truncated': False, 'frames': [
+        {'method': base + method, 'lineNumber': line_no, 'bytecodeIndex': 1, 'type': 1}
+        for (method, line_no) in frames
+    ]}
+
+
+def sample(thread, stack_trace_key):
+    return event(EXECUTION_SAMPLE, {'startTime': 10, 'sampledThread': thread, 'stackTrace': stack_trace_key, 'state': 1})
+
+
+def build():
+    """ Return the content of example.jfr"""
+    groups = [(1, {'parent': 0, 'name': 'main'})]
+    frame_types = [(1, {'description': 'Interpreted'})]
+    states = [(1, {'name': 'STATE_RUNNABLE'})]
+
+    # Thread 1: main;compute x3, main;compute;HashMap.put x2, main;fib;fib;fib x1
+    base = 100
+    (symbols, classes, packages, methods) = method_pools(base)
+    stack_traces = [
+        (base + 1, stack_trace(base, [(2, 12), (1, 5)])),
+        (base + 2, stack_trace(base, [(3, 612), (2, 14), (1, 5)])),
+        (base + 3, stack_trace(base, [(4, 20), (4, 21), (4, 21), (1, 6)])),
+    ]
+    strings = [(1, 'main')]
+    threads = [(7, {'osName': 'main', 'osThreadId': 4242, 'javaName': StringRef(1), 'javaThreadId': 1, 'group': 1})]
+    events = [sample(7, base + 1)] * 3
+    events += [event(CPU_LOAD, {'startTime': 11, 'jvmUser': 0.5, 'jvmSystem': 0.1, 'machineTotal': 0.9})]
+    events += [sample(7, base + 2)] * 2 + [sample(7, base + 3)]
+    first = chunk(events, [
+        [(20, strings), (31, groups), (21, threads), (27, frame_types), (28, states), (23, symbols),
+         (29, packages), (22, classes), (24, methods), (25, stack_traces)],
+    ])
+
+    # Thread 1: main;compute x2, Thread 2: Thread.run;work x4
+    base = 500
+    (symbols, classes, packages, methods) = method_pools(base)
+    stack_traces = [
+        (base + 1, stack_trace(base, [(2, 12), (1, 5)])),
+        (base + 9, stack_trace(base, [(5, 30), (6, 748)])),
+    ]
+    threads = [(8, {'osName': 'main', 'osThreadId': 4242, 'javaName': 'main', 'javaThreadId': 1, 'group': 1}),
+               (9, {'osName': 'worker', 'osThreadId': 4243, 'javaName': 'worker', 'javaThreadId': 2, 'group': 1})]
+    events = [sample(8, base + 1)] * 2 + [sample(9, base + 9)] * 4
+    second = chunk(events, [
+        [(31, groups), (21, threads), (27, frame_types), (28, states), (23, symbols)],
+        [(29, packages), (22, classes), (24, methods), (25, stack_traces)],
+    ])
+
+    return first + second
+
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'example.jfr'), 'wb') as fh:
+        fh.write(build())
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2013, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import unicode_literals
+
+import argparse
+import json
+import unittest
+
+from stackcollapse_common import *
+
+try:
+    # Python 2
+    from StringIO import StringIO
+except ImportError:
+    # Python 3
+    from io import StringIO
+
+
+def make_filter(**kwargs):
+    return StackFilter(lambda frame: frame.split(':', 1)[0], lambda method: method, **kwargs)
+
+
+class TestStackFilter(unittest.TestCase):
+
+    # Stacks are ordered from the leaf to the root
+    stack = ['c.Leaf.run:3', 'b.Proxy.invoke:2', 'a.Main.main:1']
+
+    def test_no_filter(self):
+        self.assertEqual(self.stack, make_filter()(self.stack))
+
+    def test_exclude(self):
+        stack_filter = make_filter(exclude=['Proxy'])
+        self.assertEqual(['c.Leaf.run:3', 'a.Main.main:1'], stack_filter(self.stack))
+
+    def test_include(self):
+        stack_filter = make_filter(include=[r'^a\.', r'^c\.'])
+        self.assertEqual(['c.Leaf.run:3', 'a.Main.main:1'], stack_filter(self.stack))
+
+    def test_root(self):
+        stack_filter = make_filter(root='Proxy')
+        self.assertEqual(['c.Leaf.run:3', 'b.Proxy.invoke:2'], stack_filter(self.stack))
+
+    def test_root_not_found(self):
+        stack_filter = make_filter(root='Missing')
+        self.assertEqual([], stack_filter(self.stack))
+
+    def test_max_depth(self):
+        stack_filter = make_filter(max_depth=2)
+        self.assertEqual(['b.Proxy.invoke:2', 'a.Main.main:1'], stack_filter(self.stack))
+
+    def test_collapse_recursion(self):
+        stack = ['c.Leaf.run:3', 'b.Fib.fib:7', 'b.Fib.fib:8', 'b.Fib.fib:8', 'a.Main.main:1']
+        stack_filter = make_filter(collapse_recursion=True)
+        self.assertEqual(['c.Leaf.run:3', 'b.Fib.fib:8', 'a.Main.main:1'], stack_filter(stack))
+
+    def test_collapse_recursion_across_excluded_frames(self):
+        stack = ['b.Fib.fib:7', 'b.Proxy.invoke:2', 'b.Fib.fib:8', 'a.Main.main:1']
+        stack_filter = make_filter(exclude=['Proxy'], collapse_recursion=True)
+        self.assertEqual(['b.Fib.fib:8', 'a.Main.main:1'], stack_filter(stack))
+
+    def test_regexes_are_evaluated_once_per_method(self):
+        names = []
+
+        def name_of(method):
+            names.append(method)
+            return method
+
+        stack_filter = StackFilter(lambda frame: frame.split(':', 1)[0], name_of, exclude=['Proxy'])
+        stack_filter(self.stack)
+        stack_filter(['b.Proxy.invoke:5', 'a.Main.main:4'])
+        self.assertEqual(sorted(['c.Leaf.run', 'b.Proxy.invoke', 'a.Main.main']), sorted(names))
+
+    def test_max_depth_must_be_positive(self):
+        parser = argparse.ArgumentParser()
+        add_filter_arguments(parser)
+        self.assertEqual(2, parser.parse_args(['--max-depth', '2']).max_depth)
+        for value in ('0', '-1'):
+            self.assertRaises(SystemExit, parser.parse_args, ['--max-depth', value])
+
+
+class TestPruneStacks(unittest.TestCase):
+
+    folded_stacks = {
+        'main;a;b': 10,
+        'main;a;c': 1,
+        'main;a': 2,
+        'main;d': 1,
+        'other': 1,
+    }
+
+    def test_no_pruning(self):
+        self.assertEqual(self.folded_stacks, prune_stacks(self.folded_stacks))
+
+    def test_min_count_merges_into_ancestor(self):
+        self.assertEqual({
+            'main;a;b': 10,
+            'main;a': 3,
+            'main': 1,
+        }, prune_stacks(self.folded_stacks, min_count=2))
+
+    def test_min_count_preserves_surviving_counts(self):
+        pruned_stacks = prune_stacks(self.folded_stacks, min_count=2)
+        self.assertEqual(sum(self.folded_stacks.values()) - self.folded_stacks['other'],
+                         sum(pruned_stacks.values()))
+
+    def test_min_percent(self):
+        self.assertEqual(
+            prune_stacks(self.folded_stacks, min_count=2),
+            prune_stacks(self.folded_stacks, min_percent=10))
+
+    def test_max_stacks(self):
+        self.assertEqual({
+            'main;a;b': 10,
+            'main;a': 2,
+        }, prune_stacks(self.folded_stacks, max_stacks=2))
+
+    def test_max_stacks_must_be_positive(self):
+        parser = argparse.ArgumentParser()
+        add_pruning_arguments(parser)
+        self.assertEqual(1, parser.parse_args(['--max-stacks', '1']).max_stacks)
+        self.assertRaises(SystemExit, parser.parse_args, ['--max-stacks', '0'])
+
+
+class TestSpillingCounter(unittest.TestCase):
+
+    stacks = ['main;b', 'main;a', 'main;\xe9', 'main;a;c', 'main;b', 'main;a', 'main;b']
+
+    def count(self, max_memory, max_runs=None):
+        counter = SpillingCounter(max_memory)
+        if max_runs:
+            counter.MAX_RUNS = max_runs
+        for stack in self.stacks:
+            counter[stack] += 1
+        return counter
+
+    def test_spill_when_budget_is_exceeded(self):
+        counter = self.count(1)
+        self.assertEqual(len(self.stacks), len(counter.runs))
+        self.assertEqual([('main;a', 2), ('main;a;c', 1), ('main;b', 3), ('main;\xe9', 1)], list(counter.items()))
+
+    def test_runs_are_merged_once_there_are_too_many(self):
+        counter = self.count(1, max_runs=3)
+        self.assertTrue(len(counter.runs) < 3)
+        self.assertEqual([('main;a', 2), ('main;a;c', 1), ('main;b', 3), ('main;\xe9', 1)], list(counter.items()))
+
+    def test_same_result_as_in_memory_counting(self):
+        counts = {}
+        for stack in self.stacks:
+            counts[stack] = counts.get(stack, 0) + 1
+        expected = [(stack, counts[stack]) for stack in sorted(counts)]
+
+        for max_memory in (1, 300, 10 ** 6):
+            self.assertEqual(expected, list(self.count(max_memory).items()))
+
+
+class TestWriteSpeedscope(unittest.TestCase):
+
+    def write(self, folded_stacks, **kwargs):
+        out = StringIO()
+        write_speedscope(folded_stacks, out, **kwargs)
+        return json.loads(out.getvalue())
+
+    def test_one_profile_per_thread(self):
+        document = self.write([
+            ('Thread 1;main;a', 3),
+            ('Thread 1;main;a;b', 2),
+            ('Thread 2;run', 4),
+        ], name='example')
+
+        self.assertEqual(SPEEDSCOPE_SCHEMA, document['$schema'])
+        self.assertEqual('example', document['name'])
+        frames = [frame['name'] for frame in document['shared']['frames']]
+        self.assertEqual(['main', 'a', 'b', 'run'], frames)
+
+        profiles = document['profiles']
+        self.assertEqual(['Thread 1', 'Thread 2'], [profile['name'] for profile in profiles])
+        self.assertEqual([[0, 1], [0, 1, 2]], profiles[0]['samples'])
+        self.assertEqual([3, 2], profiles[0]['weights'])
+        self.assertEqual(5, profiles[0]['endValue'])
+        self.assertEqual([[3]], profiles[1]['samples'])
+        self.assertEqual([4], profiles[1]['weights'])
+
+    def test_thread_frame_alone(self):
+        # Pruning can merge stacks into their thread frame, which sorts apart from the thread stacks
+        document = self.write(sorted([('Thread 1', 3), ('Thread 1;a', 2), ('Thread 10;b', 1), ('Thread 2', 4)]))
+
+        profiles = dict((profile['name'], profile) for profile in document['profiles'])
+        self.assertEqual(3, len(document['profiles']))
+        self.assertEqual(['b', 'a'], [frame['name'] for frame in document['shared']['frames']])
+        self.assertEqual([[], [1]], profiles['Thread 1']['samples'])
+        self.assertEqual([3, 2], profiles['Thread 1']['weights'])
+        self.assertEqual([[0]], profiles['Thread 10']['samples'])
+        self.assertEqual([[]], profiles['Thread 2']['samples'])
+        self.assertEqual([4], profiles['Thread 2']['weights'])
+
+    def test_thread_stacks_must_be_consecutive(self):
+        stacks = [('Thread 1;a', 1), ('Thread 2;b', 1), ('Thread 1;c', 1)]
+        self.assertRaises(ValueError, write_speedscope, stacks, StringIO())
+
+    def test_stacks_without_thread(self):
+        document = self.write([('main;a', 3), ('main;\xe9', 1)], name='example', unit='bytes')
+
+        self.assertEqual(1, len(document['profiles']))
+        profile = document['profiles'][0]
+        self.assertEqual('example', profile['name'])
+        self.assertEqual('bytes', profile['unit'])
+        self.assertEqual([[0, 1], [0, 2]], profile['samples'])
+        self.assertEqual(['main', 'a', '\xe9'], [frame['name'] for frame in document['shared']['frames']])
+
+    def test_no_stacks(self):
+        document = self.write([])
+        self.assertEqual([], document['profiles'])
+        self.assertEqual([], document['shared']['frames'])
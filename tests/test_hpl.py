@@ -25,8 +25,11 @@
 
 from __future__ import division
 
+import json
 import os
+import re
 import unittest
+from io import BytesIO
 
 try:
     # Python 2
@@ -42,6 +45,45 @@ def get_ref_file(file_name):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ref', 'hpl', file_name)
 
 
+class ParsingTest(unittest.TestCase):
+
+    def test_class_names_are_shared(self):
+        (_, methods) = parse_hpl(get_ref_file("example_with_new_method_signature.hpl"))
+
+        class_names = {}
+        for method in methods.values():
+            class_name = class_names.setdefault(method.class_name, method.class_name)
+            self.assertTrue(class_name is method.class_name)
+
+    def test_method_table(self):
+        (_, methods) = parse_hpl(get_ref_file("example_with_new_method_signature.hpl"))
+
+        self.assertEqual(Method('Lsun/misc/Unsafe;', 'ensureClassInitialized'), methods[140551935483000])
+        self.assertEqual(Method('/Error/', 'GC Active[ERR=-2]'), methods[-3])
+
+    def test_iter_hpl_reads_traces_lazily(self):
+        methods = {}
+        traces = iter_hpl(get_ref_file("example_with_full_frame.hpl"), methods)
+        first = next(traces)
+        methods_read = len(methods)
+        rest = list(traces)
+
+        self.assertTrue(methods_read < len(methods))
+        self.assertEqual(parse_hpl(get_ref_file("example_with_full_frame.hpl")), ([first] + rest, methods))
+
+    def test_parse_hpl_string(self):
+        strings = {}
+        first = parse_hpl_string(BytesIO(b'\x00\x00\x00\x03Foo'), strings)
+        second = parse_hpl_string(BytesIO(b'\x00\x00\x00\x03Foo'), strings)
+        self.assertEqual('Foo', first)
+        self.assertTrue(first is second)
+
+    def test_skip_hpl_string(self):
+        fh = BytesIO(b'\x00\x00\x00\x03Foo\x00\x00\x00\x03Bar')
+        skip_hpl_string(fh)
+        self.assertEqual('Bar', parse_hpl_string(fh))
+
+
 class AcceptanceTest(unittest.TestCase):
 
     def run_example_with(self, hpl_file="example.hpl", args=None):
@@ -71,6 +113,24 @@ class AcceptanceTest(unittest.TestCase):
         sample_count = sum([int(line.split(" ")[-1]) for line in self.lines])
         self.assertEqual(5, sample_count)
 
+    def test_speedscope_format(self):
+        capturer = StringIO()
+        main(argv=[get_ref_file('example.hpl'), '--format', 'speedscope', '--discard-thread'], out=capturer)
+        document = json.loads(capturer.getvalue())
+
+        self.assertEqual(['example.hpl'], [profile['name'] for profile in document['profiles']])
+        self.assertEqual(5, document['profiles'][0]['endValue'])
+
+    def test_speedscope_format_with_pruned_stacks(self):
+        capturer = StringIO()
+        main(argv=[get_ref_file('example_with_full_frame.hpl'), '--format', 'speedscope', '--min-count', '30'],
+             out=capturer)
+        document = json.loads(capturer.getvalue())
+
+        names = [profile['name'] for profile in document['profiles']]
+        self.assertEqual(len(set(names)), len(names))
+        self.assertTrue(any([] in profile['samples'] for profile in document['profiles']))
+
     def test_should_contains_threads(self):
         self.run_example_with()
 
@@ -164,3 +224,62 @@ class AcceptanceTest(unittest.TestCase):
             for frame in collapsed_stack.split(';')[1:]:
                 self.assertFalse(re.match('.*:-\d+$', frame), frame)
 
+    def test_exclude_frames(self):
+        self.run_example_with(args=['--exclude', r'^java\.'])
+
+        for line in self.lines:
+            (collapsed_stack, _) = line.rsplit(' ', 1)
+            for frame in collapsed_stack.split(';'):
+                self.assertFalse(frame.startswith('java.'), frame)
+
+    def test_root_discards_callers_and_other_stacks(self):
+        self.run_example_with(args=['--root', r'Example\.subMethod', '--discard-thread'])
+
+        self.assertEqual(4, len(self.lines))
+        for line in self.lines:
+            self.assertTrue(line.startswith('Example.subMethod;'), line)
+
+    def test_max_depth_merges_stacks(self):
+        self.run_example_with(args=['--max-depth', '2'])
+
+        self.assertEqual(2, len(self.lines))
+        sample_count = sum([int(line.split(" ")[-1]) for line in self.lines])
+        self.assertEqual(5, sample_count)
+
+    def test_collapse_recursion(self):
+        self.run_example_with(args=['--collapse-recursion'])
+
+        for line in self.lines:
+            (collapsed_stack, _) = line.rsplit(' ', 1)
+            frames = collapsed_stack.split(';')
+            for (caller, callee) in zip(frames, frames[1:]):
+                self.assertNotEqual(caller, callee)
+
+    def test_min_count_preserves_sample_count(self):
+        self.run_example_with(args=['--max-depth', '4', '--min-count', '2'])
+
+        self.assertEqual(3, len(self.lines))
+        sample_count = sum([int(line.split(" ")[-1]) for line in self.lines])
+        self.assertEqual(5, sample_count)
+
+    def test_max_stacks(self):
+        self.run_example_with(args=['--max-stacks', '2'])
+
+        self.assertEqual(2, len(self.lines))
+
+    def test_max_memory_gives_same_result(self):
+        self.run_example_with(hpl_file="example_with_full_frame.hpl", args=['--discard-lineno'])
+        in_memory_lines = self.lines
+
+        entry_overhead = SpillingCounter.ENTRY_OVERHEAD
+        SpillingCounter.ENTRY_OVERHEAD = 50 * 1024  # Spill every 20 distinct stacks
+        try:
+            self.run_example_with(hpl_file="example_with_full_frame.hpl", args=['--discard-lineno', '--max-memory', '1'])
+        finally:
+            SpillingCounter.ENTRY_OVERHEAD = entry_overhead
+
+        self.assertEqual(in_memory_lines, self.lines)
+
+    def test_max_memory_must_be_positive(self):
+        for value in ('0', '-1'):
+            self.assertRaises(SystemExit, self.run_example_with, args=['--max-memory', value])
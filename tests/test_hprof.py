@@ -25,6 +25,7 @@
 
 from __future__ import unicode_literals
 
+import json
 import os
 import unittest
 
@@ -36,6 +37,7 @@ except ImportError:
     from io import StringIO
 
 from stackcollapse_hprof import *
+from stackcollapse_common import StackFilter
 
 REF_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ref', 'hprof')
 
@@ -128,6 +130,27 @@ class TestParsing(unittest.TestCase):
         content = get_file_content(filename)
         self.assertTrue("récursif" in content)
 
+    def test_mapped_file_gives_same_result(self):
+        for ref in refs:
+            if not os.path.exists(ref):
+                continue
+            content = get_file_content(ref)
+            mapped_content = map_file(ref)
+            self.assertTrue(header_match(mapped_content))
+            self.assertFalse(is_tracing(mapped_content))
+            self.assertEquals(get_stacks(content), get_stacks(mapped_content))
+            self.assertEquals(get_counts(content), get_counts(mapped_content))
+            mapped_content.close()
+
+    def test_can_read_utf8_from_mapped_file(self):
+        filename = os.path.join(REF_DIR, 'with_non_ascii_identifier.hprof.txt')
+        stacks = get_stacks(map_file(filename))
+        self.assertTrue(any("récursif" in frame for stack in stacks.values() for frame in stack))
+
+    def test_is_tracing_from_mapped_file(self):
+        filename = os.path.join(REF_DIR, 'cpu=times,depth=100,lineno=n,thread=n.hprof.txt')
+        self.assertTrue(is_tracing(map_file(filename)))
+
 
 class TestStack(unittest.TestCase):
 
@@ -183,6 +206,17 @@ class TestStack(unittest.TestCase):
         self.assertEquals(1, len(stacks))
         self.assertEquals(2, len(stacks['301000']))
 
+    def test_bytes_stack(self):
+        stack = b"\n".join([
+            b'TRACE 301000: (thread=200001)',
+            b'\tjava.lang.ClassLoader.defineClass1(ClassLoader.java:Unknown line)',
+            b'\tjava.lang.ClassLoader.defineClass(ClassLoader.java:791)',
+            b''
+        ])
+        stacks = get_stacks(stack, shorten_pkgs=True)
+        self.assertEquals(["j.l.ClassLoader.defineClass1", "j.l.ClassLoader.defineClass:791", "Thread 200001"],
+                          stacks['301000'])
+
     def test_abbreviate_package(self):
         self.assertEqual('f.b.Class.method', abbreviate_package("foo.bar.Class.method"))
 
@@ -198,6 +232,33 @@ class TestStack(unittest.TestCase):
         self.assertEquals("j.l.ClassLoader.defineClass:791", stacks['301000'][1])
         self.assertEquals("Thread 200001", stacks['301000'][2])
 
+    def test_stack_filter(self):
+        stack = "\n".join([
+            'TRACE 301000: (thread=200001)',
+            '\tjava.lang.ClassLoader.defineClass1(ClassLoader.java:Unknown line)',
+            '\tjava.lang.ClassLoader.defineClass(ClassLoader.java:791)',
+            '\tjava.lang.ClassLoader.defineClass(ClassLoader.java:750)',
+            '\tjava.security.SecureClassLoader.defineClass(SecureClassLoader.java:142)',
+            ''
+        ])
+        stack_filter = StackFilter(get_frame_method, lambda method: method,
+                                   exclude=['defineClass1'], collapse_recursion=True)
+        stacks = get_stacks(stack, stack_filter=stack_filter)
+        self.assertEquals([
+            "java.lang.ClassLoader.defineClass:750",
+            "java.security.SecureClassLoader.defineClass:142",
+            "Thread 200001",
+        ], stacks['301000'])
+
+    def test_stack_filter_discards_empty_stacks(self):
+        stack = "\n".join([
+            'TRACE 301000: (thread=200001)',
+            '\tjava.lang.ClassLoader.defineClass1(ClassLoader.java:Unknown line)',
+            ''
+        ])
+        stack_filter = StackFilter(get_frame_method, lambda method: method, root='Missing')
+        self.assertEquals({}, get_stacks(stack, stack_filter=stack_filter))
+
 
 class TestCount(unittest.TestCase):
 
@@ -215,6 +276,53 @@ class TestCount(unittest.TestCase):
         self.assertEquals('11', counts['301004'])
 
 
+class TestSites(unittest.TestCase):
+
+    sites = '\n'.join([
+        'SITES BEGIN (ordered by live bytes) Sat Oct 18 10:12:33 2014',
+        '          percent          live          alloc\'ed  stack class',
+        ' rank   self  accum     bytes objs     bytes  objs trace name',
+        '    1 48.12% 48.12%    204800    50  16384000  4000 300010 char[]',
+        '    2 24.06% 72.18%    102400     1    409600     4 300012 java.util.HashMap$Node[]',
+        'SITES END',
+        '',
+    ])
+
+    def test_get_sites(self):
+        sites = get_sites(self.sites)
+        self.assertEquals(2, len(sites))
+        self.assertEquals(Site('300010', 'char[]', 204800, 50, 16384000, 4000), sites[0])
+
+    def test_get_sites_uses_last_record(self):
+        last_record = self.sites.replace('204800    50', '409600   100')
+        sites = get_sites(self.sites + last_record)
+        self.assertEquals(409600, sites[0].live_bytes)
+
+    def test_no_sites(self):
+        filename = get_ref_file(True, True)
+        self.assertEquals([], get_sites(get_file_content(filename)))
+
+    def test_get_allocation_stacks(self):
+        stacks = {'300010': ['java.util.Arrays.copyOf:2367', 'Thread 200001']}
+        folded_stacks = get_allocation_stacks(stacks, get_sites(self.sites), 'alloc_objs')
+        self.assertEquals({'Thread 200001;java.util.Arrays.copyOf:2367;char[]': 4000}, folded_stacks)
+
+    def test_get_allocation_stacks_applies_frame_options(self):
+        stacks = {
+            '300010': ['java.util.Arrays.copyOf:2367', 'Thread 200001'],
+            '300012': ['java.util.HashMap.resize:580', 'Main.main:3', 'Thread 200001'],
+        }
+        stack_filter = StackFilter(get_frame_method, lambda method: method, exclude=['^char', 'Arrays'])
+        folded_stacks = get_allocation_stacks(stacks, get_sites(self.sites), 'alloc_objs', True, stack_filter)
+        # The char[] site only has excluded frames
+        self.assertEquals({'Thread 200001;Main.main:3;java.util.HashMap.resize:580;j.u.HashMap$Node[]': 4},
+                          folded_stacks)
+
+    def test_abbreviate_class_name(self):
+        self.assertEquals('j.u.HashMap$Node', abbreviate_class_name('java.util.HashMap$Node'))
+        self.assertEquals('char[]', abbreviate_class_name('char[]'))
+
+
 class TestEndToEnd(unittest.TestCase):
 
     def test_end_to_end(self):
@@ -235,3 +343,71 @@ class TestEndToEnd(unittest.TestCase):
         capturer = StringIO()
         main(argv=[os.path.join(REF_DIR, 'with_non_ascii_identifier.hprof.txt')], out=capturer)
 
+    def test_end_to_end_with_root(self):
+        capturer = StringIO()
+        main(argv=[get_ref_file(True, True), '--root', 'SecureClassLoader.defineClass', '--discard-thread'], out=capturer)
+        content = capturer.getvalue()
+
+        lines = [line for line in content.split('\n') if line]
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.startswith('java.security.SecureClassLoader.defineClass'), line)
+
+    def test_end_to_end_filtered_stacks_are_merged(self):
+        capturer = StringIO()
+        main(argv=[get_ref_file(True, True), '--max-depth', '2'], out=capturer)
+        content = capturer.getvalue()
+
+        lines = [line for line in content.split('\n') if line]
+        stacks = [line.rsplit(' ', 1)[0] for line in lines]
+        self.assertEqual(len(set(stacks)), len(stacks))
+        self.assertEqual(981, sum([int(line.split(" ")[-1]) for line in lines]))
+
+    def test_end_to_end_filtering_every_stack(self):
+        capturer = StringIO()
+        self.assertEqual(0, main(argv=[get_ref_file(True, True), '--root', 'NoSuchMethod'], out=capturer))
+        self.assertEqual('', capturer.getvalue())
+
+    def test_end_to_end_with_max_stacks(self):
+        capturer = StringIO()
+        main(argv=[get_ref_file(True, True), '--max-stacks', '10'], out=capturer)
+        content = capturer.getvalue()
+
+        lines = [line for line in content.split('\n') if line]
+        self.assertEquals(10, len(lines))
+
+    def test_end_to_end_speedscope(self):
+        capturer = StringIO()
+        main(argv=[get_ref_file(True, True), '--format', 'speedscope'], out=capturer)
+        document = json.loads(capturer.getvalue())
+
+        self.assertTrue(document['profiles'])
+        for profile in document['profiles']:
+            self.assertTrue(profile['name'].startswith('Thread '))
+            self.assertEqual(len(profile['samples']), len(profile['weights']))
+        self.assertEqual(981, sum(sum(profile['weights']) for profile in document['profiles']))
+
+    def test_end_to_end_sites(self):
+        capturer = StringIO()
+        main(argv=[os.path.join(REF_DIR, 'heap=sites,depth=4,thread=y.hprof.txt'), '--sites', 'live_bytes'], out=capturer)
+        content = capturer.getvalue()
+
+        lines = [line for line in content.split('\n') if line]
+        self.assertEquals(4, len(lines))
+        self.assertTrue('Thread 200001;Allocator.main:9;Allocator.describe:18;'
+                        'java.lang.StringBuilder.toString:405;java.lang.String 22400' in lines)
+        self.assertEquals(204800 + 102400 + 81920 + 22400, sum([int(line.split(" ")[-1]) for line in lines]))
+
+    def test_end_to_end_sites_with_frame_options(self):
+        capturer = StringIO()
+        main(argv=[os.path.join(REF_DIR, 'heap=sites,depth=4,thread=y.hprof.txt'), '--sites', 'alloc_bytes',
+                   '--shorten-pkgs', '--exclude', 'String'], out=capturer)
+        content = capturer.getvalue()
+
+        lines = [line for line in content.split('\n') if line]
+        self.assertTrue('Thread 200001;Allocator.main:9;Allocator.describe:18 1280000' in lines)
+        self.assertTrue('Thread 200001;Allocator.index:25;j.u.HashMap.put:611;j.u.HashMap.putVal:630;'
+                        'j.u.HashMap.newNode:1742;j.u.HashMap$Node 819200' in lines)
+        for line in lines:
+            self.assertFalse('String' in line, line)
+            self.assertFalse('java.' in line, line)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2014, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import json
+import os
+import io
+import re
+import unittest
+
+try:
+    # Python 2
+    from StringIO import StringIO
+except ImportError:
+    # Python 3
+    from io import StringIO
+
+from stackcollapse_jfr import *
+
+
+def get_ref_file(file_name):
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ref', 'jfr', file_name)
+
+
+def load_make_example():
+    """ Import tests/ref/jfr/make_example.py, which is not in a package"""
+    path = get_ref_file('make_example.py')
+    try:
+        import importlib.util
+    except ImportError:  # Python 2
+        import imp
+        return imp.load_source('make_example', path)
+    spec = importlib.util.spec_from_file_location('make_example', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestChunkReader(unittest.TestCase):
+
+    def test_read_compressed_long(self):
+        reader = ChunkReader(bytearray([0x05, 0xac, 0x02, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0xff]), True)
+        self.assertEqual(5, reader.read_long())
+        self.assertEqual(300, reader.read_long())
+        self.assertEqual(-1, reader.read_long())
+
+    def test_read_compressed_int_is_signed(self):
+        reader = ChunkReader(bytearray([0xff, 0xff, 0xff, 0xff, 0x0f]), True)
+        self.assertEqual(-1, reader.read_int())
+
+    def test_read_fixed_int(self):
+        reader = ChunkReader(bytearray([0x00, 0x00, 0x01, 0x2c]), False)
+        self.assertEqual(300, reader.read_int())
+
+    def test_read_strings(self):
+        reader = ChunkReader(bytearray(b'\x00\x01\x03\x02ab\x02\x07\x05\x01\xe9'), True)
+        self.assertEqual(None, reader.read_string())
+        self.assertEqual('', reader.read_string())
+        self.assertEqual('ab', reader.read_string())
+        self.assertEqual(7, reader.read_string().index)
+        self.assertEqual(u'\xe9', reader.read_string())
+
+
+class TestChunkResolver(unittest.TestCase):
+
+    def get_resolver(self, methods):
+        pools = collections.defaultdict(dict)
+        pools['jdk.types.Symbol'].update({1: {'string': 'a/b/Example'}, 2: {'string': 'main'}})
+        pools['java.lang.Class'][1] = {'name': 1}
+        pools['jdk.types.Method'].update(methods)
+        pools['jdk.types.StackTrace'][1] = {'frames': [{'method': 1, 'lineNumber': 5}]}
+        return ChunkResolver(pools, False)
+
+    def test_frames(self):
+        resolver = self.get_resolver({1: {'type': 1, 'name': 2}})
+        self.assertEqual([('a.b.Example.main', 5)], resolver.frames(1))
+
+    def test_missing_stack_trace(self):
+        resolver = self.get_resolver({1: {'type': 1, 'name': 2}})
+        with self.assertRaises(MissingConstantError) as context:
+            resolver.frames(2)
+        self.assertEqual('Missing jdk.types.StackTrace 2 in the constant pool', str(context.exception))
+
+    def test_missing_method(self):
+        resolver = self.get_resolver({})
+        with self.assertRaises(MissingConstantError) as context:
+            resolver.frames(1)
+        self.assertEqual('Missing jdk.types.Method 1 in the constant pool', str(context.exception))
+
+
+class AcceptanceTest(unittest.TestCase):
+
+    def run_example_with(self, jfr_file="example.jfr", args=None):
+        if not args:
+            args = []
+
+        capturer = StringIO()
+        main(argv=[get_ref_file(jfr_file)] + args, out=capturer)
+        content = capturer.getvalue()
+
+        self.lines = [line for line in content.split('\n') if line]
+
+    def test_samples_are_aggregated_across_chunks(self):
+        self.run_example_with()
+
+        self.assertEqual([
+            'Thread 1;Example.main:5;Example.compute:12 5',
+            'Thread 1;Example.main:5;Example.compute:14;java.util.HashMap.put:612 2',
+            'Thread 1;Example.main:6;Example.fib:21;Example.fib:21;Example.fib:20 1',
+            'Thread 2;java.lang.Thread.run:748;Example.work:30 4',
+        ], self.lines)
+
+    def test_should_contains_12_samples(self):
+        self.run_example_with()
+
+        sample_count = sum([int(line.split(" ")[-1]) for line in self.lines])
+        self.assertEqual(12, sample_count)
+
+    def test_should_not_contains_threads(self):
+        self.run_example_with(args=['--discard-thread'])
+
+        for line in self.lines:
+            self.assertFalse(re.match(r'^Thread \d+.*', line), line)
+
+    def test_should_not_contains_lineno(self):
+        self.run_example_with(args=['--discard-lineno'])
+
+        for line in self.lines:
+            (collapsed_stack, _) = line.rsplit(' ', 1)
+            for frame in collapsed_stack.split(';'):
+                self.assertFalse(re.match(r'.*:-?\d+$', frame), frame)
+
+    def test_filters_are_supported(self):
+        self.run_example_with(args=['--discard-lineno', '--collapse-recursion', '--exclude', 'HashMap'])
+
+        self.assertEqual([
+            'Thread 1;Example.main;Example.compute 7',
+            'Thread 1;Example.main;Example.fib 1',
+            'Thread 2;java.lang.Thread.run;Example.work 4',
+        ], self.lines)
+
+    def test_speedscope_format(self):
+        capturer = StringIO()
+        main(argv=[get_ref_file('example.jfr'), '--format', 'speedscope'], out=capturer)
+        document = json.loads(capturer.getvalue())
+
+        self.assertEqual(['Thread 1', 'Thread 2'], [profile['name'] for profile in document['profiles']])
+        self.assertEqual(12, sum(sum(profile['weights']) for profile in document['profiles']))
+
+    def test_example_is_generated_by_make_example(self):
+        with open(get_ref_file('example.jfr'), 'rb') as fh:
+            self.assertEqual(fh.read(), load_make_example().build())
+
+    def test_jdk_recording(self):
+        # keytool.folded was built from the output of the JDK jfr tool, see keytool.txt
+        self.run_example_with(jfr_file='keytool.jfr')
+
+        with io.open(get_ref_file('keytool.folded'), encoding='utf-8') as fh:
+            expected = [line for line in fh.read().split('\n') if line]
+        self.assertEqual(expected, self.lines)
+
+    def test_should_fail_on_non_jfr_file(self):
+        hpl_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ref', 'hpl', 'example.hpl')
+        self.assertRaises(Exception, main, argv=[hpl_file], out=StringIO())
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2014, Clément MATHIEU
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import os
+import sys
+import threading
+import unittest
+
+try:
+    import asyncio
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+    from io import StringIO
+
+    import stackcollapse_hpl
+    import stackcollapse_hprof
+    import stackcollapse_jfr
+    from stackcollapse_server import *
+except (ImportError, SyntaxError):  # Python 2
+    asyncio = None
+
+REF_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ref')
+
+
+@unittest.skipIf(asyncio is None, 'Requires Python 3')
+class ServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.server = ProfileServer(REF_DIR, 64 * 1024 * 1024, cls.loop)
+        cls.tcp_server = cls.loop.run_until_complete(cls.server.start('127.0.0.1', 0))
+        cls.port = cls.tcp_server.sockets[0].getsockname()[1]
+        cls.thread = threading.Thread(target=cls.loop.run_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.tcp_server.close()
+        cls.loop.run_until_complete(cls.tcp_server.wait_closed())
+        cls.loop.close()
+
+    def get(self, path):
+        response = urlopen('http://127.0.0.1:%s%s' % (self.port, path))
+        return response.read().decode('utf-8')
+
+    def get_lines(self, path):
+        return [line for line in self.get(path).split('\n') if line]
+
+    def assertStatus(self, status, path):
+        with self.assertRaises(HTTPError) as context:
+            self.get(path)
+        self.assertEqual(status, context.exception.code)
+
+    def run_script(self, module, path, args):
+        capturer = StringIO()
+        module.main(argv=[os.path.join(REF_DIR, path)] + args, out=capturer)
+        return [line for line in capturer.getvalue().split('\n') if line]
+
+    def run_hpl(self, hpl_file, args):
+        return self.run_script(stackcollapse_hpl, os.path.join('hpl', hpl_file), args)
+
+    def test_folded_hpl_matches_script(self):
+        lines = self.get_lines('/folded?file=hpl/example.hpl')
+        self.assertEqual(self.run_hpl('example.hpl', []), lines)
+
+    def test_folded_with_options_matches_script(self):
+        lines = self.get_lines('/folded?file=hpl/example_with_full_frame.hpl'
+                               '&discard_lineno=1&discard_thread=1&exclude=%5Ejava%5C.&min_count=2')
+        args = ['--discard-lineno', '--discard-thread', '--exclude', r'^java\.', '--min-count', '2']
+        self.assertEqual(self.run_hpl('example_with_full_frame.hpl', args), lines)
+
+        lines = self.get_lines('/folded?file=hpl/example_with_full_frame.hpl&shorten_pkgs=1&exclude=%5Ej%5C.')
+        args = ['--shorten-pkgs', '--exclude', r'^j\.']
+        self.assertEqual(self.run_hpl('example_with_full_frame.hpl', args), lines)
+
+        lines = self.get_lines('/folded?file=jfr/example.jfr&shorten_pkgs=1')
+        self.assertEqual(self.run_script(stackcollapse_jfr, 'jfr/example.jfr', ['--shorten-pkgs']), lines)
+
+        hprof_file = 'hprof/cpu=samples,depth=100,interval=10,lineno=y,thread=y.hprof.txt'
+        query = hprof_file.replace('=', '%3D').replace(',', '%2C')
+        lines = self.get_lines('/folded?file=%s&shorten_pkgs=1&min_count=1' % query)
+        args = ['--shorten-pkgs', '--min-count', '1']
+        self.assertEqual(sorted(self.run_script(stackcollapse_hprof, hprof_file, args)), lines)
+
+    def test_folded_hprof(self):
+        lines = self.get_lines('/folded?file=hprof/cpu%3Dsamples%2Cdepth%3D100%2Cinterval%3D10%2Clineno%3Dy%2Cthread%3Dy.hprof.txt')
+        sample_count = sum([int(line.split(" ")[-1]) for line in lines])
+        # Two traces of the reference file share the same stack, they are merged
+        self.assertEqual(889, len(lines))
+        self.assertEqual(981, sample_count)
+
+    def test_folded_jfr(self):
+        lines = self.get_lines('/folded?file=jfr/example.jfr&discard_thread=1&discard_lineno=1')
+        self.assertEqual([
+            'Example.main;Example.compute 5',
+            'Example.main;Example.compute;java.util.HashMap.put 2',
+            'Example.main;Example.fib;Example.fib;Example.fib 1',
+            'java.lang.Thread.run;Example.work 4',
+        ], lines)
+
+    def test_time_window(self):
+        hpl_file = 'hpl/example_with_new_method_signature.hpl'
+        all_lines = self.get_lines('/folded?file=%s' % hpl_file)
+        first_half = self.get_lines('/folded?file=%s&end=0.25' % hpl_file)
+        second_half = self.get_lines('/folded?file=%s&start=0.25' % hpl_file)
+
+        def count(lines):
+            return sum([int(line.split(" ")[-1]) for line in lines])
+
+        self.assertTrue(0 < count(first_half) < count(all_lines))
+        self.assertEqual(count(all_lines), count(first_half) + count(second_half))
+
+    def test_time_window_requires_timestamps(self):
+        self.assertStatus(400, '/folded?file=hpl/example.hpl&start=1')
+
+    def test_top(self):
+        top = json.loads(self.get('/top?file=jfr/example.jfr&discard_lineno=1&n=2'))
+        self.assertEqual([
+            {'name': 'Example.compute', 'self': 5, 'total': 7},
+            {'name': 'Example.work', 'self': 4, 'total': 4},
+        ], top)
+
+    def test_profiles(self):
+        self.get('/folded?file=hpl/example.hpl')
+        profiles = json.loads(self.get('/profiles'))
+        self.assertTrue(any(profile['file'] == os.path.join('hpl', 'example.hpl') for profile in profiles))
+
+    def test_concurrent_requests(self):
+        results = []
+
+        def request():
+            results.append(self.get_lines('/folded?file=hpl/example_with_full_frame.hpl'))
+
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(4, len(results))
+        for lines in results:
+            self.assertEqual(results[0], lines)
+
+    def test_errors(self):
+        self.assertStatus(400, '/folded')
+        self.assertStatus(404, '/folded?file=missing.hpl')
+        self.assertStatus(403, '/folded?file=../test_server.py')
+        self.assertStatus(400, '/folded?file=hpl/example.hpl&max_depth=a')
+        self.assertStatus(400, '/folded?file=hpl/example.hpl&max_depth=0')
+        self.assertStatus(400, '/folded?file=hpl/example.hpl&max_stacks=0')
+        self.assertStatus(404, '/unknown')
+
+
+@unittest.skipIf(asyncio is None, 'Requires Python 3')
+class ProfileTest(unittest.TestCase):
+
+    def test_size_is_computed_once_loaded(self):
+        profile = Profile('example', 'hpl')
+        profile.add('Thread 1', ['b', 'a'])
+        self.assertEqual(0, profile.size)
+
+        profile.finish()
+        self.assertEqual(profile._estimate_size(), profile.size)
+        self.assertTrue(profile.size > 0)
+
+    def test_get_folded_text(self):
+        profile = Profile('example', 'hpl')
+        for frames in (['b', 'a'], ['c', 'a'], ['b', 'a']):
+            profile.add('Thread 1', frames)
+        profile.finish()
+
+        options = parse_view_options({})
+        self.assertEqual('Thread 1;a;b 2\nThread 1;a;c 1\n', get_folded_text(profile, options))
+
+
+@unittest.skipIf(asyncio is None, 'Requires Python 3')
+class ProfileCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_profiles_are_evicted(self):
+        loop = asyncio.new_event_loop()
+        try:
+            cache = ProfileCache(1, loop)
+            for name in ('example.hpl', 'example_with_full_frame.hpl'):
+                loop.run_until_complete(cache.get(os.path.join(REF_DIR, 'hpl', name)))
+
+            self.assertEqual([os.path.join(REF_DIR, 'hpl', 'example_with_full_frame.hpl')],
+                             [profile.path for profile in cache])
+        finally:
+            loop.close()